@@ -0,0 +1,275 @@
+"""
+Admission control: per-key token buckets and per-class concurrency caps, both answered
+with 429 and Retry-After before a request reaches MongoDB or the password hasher.
+
+Buckets (RULES) are keyed by sender user_id for sends (REST and WebSocket alike, taken in
+chat.websocket.send_chat_message) and by client IP for login and register (taken in
+AdmissionMiddleware from the path, before the body is read). Behind a reverse proxy the
+client IP is only known with ADMISSION_PROXY_HOPS set (see `client_ip`); otherwise every
+client shares the proxy's bucket. A bucket holds up to `burst`
+tokens and refills at `rate` per second; rate 0 turns a rule off. ADMISSION_STORE picks
+where buckets live: "memory" (per process, a dict lookup per request) or "mongo" (one
+atomic update on the rate_limits collection, so every worker shares the same budget).
+
+Concurrency caps (LIMITS) bound the requests in flight on this process, overall and per
+route class, so a burst is shed at the edge instead of queueing on the connection pool.
+/sse, /health and /metrics are never limited.
+"""
+import math
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Tuple
+import orjson
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+from starlette.datastructures import Headers
+from config import (
+    ADMISSION_STORE, ADMISSION_COLLECTION, ADMISSION_MAX_KEYS, ADMISSION_PROXY_HOPS,
+    ADMISSION_SEND_RATE, ADMISSION_SEND_BURST, ADMISSION_LOGIN_RATE, ADMISSION_LOGIN_BURST,
+    ADMISSION_REGISTER_RATE, ADMISSION_REGISTER_BURST, ADMISSION_API_RATE, ADMISSION_API_BURST,
+    ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_IN_FLIGHT_SEND, ADMISSION_MAX_IN_FLIGHT_AUTH,
+)
+from metrics import registry
+from database import get_db
+
+EXCLUDED_PATHS: Tuple[str, ...] = ("/sse", "/health", "/metrics")
+
+
+class Rule(NamedTuple):
+    rate: float   # tokens per second; 0 disables the rule
+    burst: float  # bucket size
+
+
+RULES: Dict[str, Rule] = {
+    "send": Rule(ADMISSION_SEND_RATE, ADMISSION_SEND_BURST),
+    "login": Rule(ADMISSION_LOGIN_RATE, ADMISSION_LOGIN_BURST),
+    "register": Rule(ADMISSION_REGISTER_RATE, ADMISSION_REGISTER_BURST),
+    "api": Rule(ADMISSION_API_RATE, ADMISSION_API_BURST),
+}
+
+# Requests in flight on this process; "all" counts every limited request. 0 is unlimited.
+LIMITS: Dict[str, int] = {
+    "all": ADMISSION_MAX_IN_FLIGHT,
+    "send": ADMISSION_MAX_IN_FLIGHT_SEND,
+    "auth": ADMISSION_MAX_IN_FLIGHT_AUTH,
+}
+
+admission_rejected = registry.counter("admission_rejected_total", "Requests rejected with 429", ("reason",))
+
+
+class MemoryBucketStore:
+    """Buckets of this process, refilled lazily on take; the least recently used are evicted."""
+    name = "memory"
+
+    def __init__(self, max_keys: int = ADMISSION_MAX_KEYS):
+        self.max_keys = max_keys
+        # key -> [tokens, refilled_at]
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    async def take(self, key: str, rule: Rule, cost: float = 1.0) -> float:
+        """Take `cost` tokens; 0 if admitted, else seconds until enough tokens are back."""
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [rule.burst, now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(rule.burst, bucket[0] + (now - bucket[1]) * rule.rate)
+            bucket[1] = now
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0.0
+        return (cost - bucket[0]) / rule.rate
+
+    def stats(self) -> dict:
+        return {"store": self.name, "keys": len(self._buckets)}
+
+
+class MongoBucketStore:
+    """
+    Buckets shared by every worker: one pipeline find_one_and_update per take, refilled
+    with the server's clock ($$NOW) so workers never disagree on elapsed time. Idle buckets
+    are full again after burst / rate seconds and expire through the expires_at TTL index.
+    If MongoDB fails the request is admitted: the limiter must not take the API down.
+    """
+    name = "mongo"
+
+    def __init__(self, get_db, collection: str = ADMISSION_COLLECTION):
+        self._get_db = get_db
+        self.collection = collection
+        self.errors = 0
+
+    async def take(self, key: str, rule: Rule, cost: float = 1.0) -> float:
+        refilled = {"$min": [rule.burst, {"$add": [
+            {"$ifNull": ["$tokens", rule.burst]},
+            {"$multiply": [{"$subtract": ["$$NOW", {"$ifNull": ["$refilled_at", "$$NOW"]}]}, rule.rate / 1000]},
+        ]}]}
+        try:
+            db = await self._get_db()
+            bucket = await db[self.collection].find_one_and_update(
+                {"_id": key},
+                [
+                    {"$set": {"tokens": refilled, "refilled_at": "$$NOW"}},
+                    {"$set": {"admitted": {"$gte": ["$tokens", cost]}}},
+                    {"$set": {
+                        "tokens": {"$cond": ["$admitted", {"$subtract": ["$tokens", cost]}, "$tokens"]},
+                        "expires_at": {"$add": ["$$NOW", math.ceil(rule.burst / rule.rate * 1000)]},
+                    }},
+                ],
+                projection={"_id": 0, "tokens": 1, "admitted": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except PyMongoError as e:
+            self.errors += 1
+            logging.error(f"Admission bucket {key} unavailable, admitting: {e}")
+            return 0.0
+        if bucket["admitted"]:
+            return 0.0
+        return (cost - bucket["tokens"]) / rule.rate
+
+    def stats(self) -> dict:
+        return {"store": self.name, "collection": self.collection, "errors": self.errors}
+
+
+def create_bucket_store(get_db):
+    if ADMISSION_STORE == "mongo":
+        return MongoBucketStore(get_db)
+    return MemoryBucketStore()
+
+
+def _too_many(reason: str, retry_after: float) -> HTTPException:
+    admission_rejected.inc(reason)
+    return HTTPException(status_code=429, detail="Too many requests, try again later",
+                         headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+class AdmissionController:
+    def __init__(self, store, rules: Dict[str, Rule] = RULES, limits: Dict[str, int] = LIMITS):
+        self.store = store
+        self.rules = dict(rules)
+        self.limits = dict(limits)
+        self.in_flight: Dict[str, int] = {name: 0 for name in self.limits}
+        self.admitted: Dict[str, int] = {}
+        self.rejected: Dict[str, int] = {}
+
+    async def admit(self, rule: str, key: str, cost: float = 1.0):
+        """Take from the `rule` bucket of `key`; raises 429 with Retry-After when it is empty."""
+        limit = self.rules[rule]
+        if limit.rate <= 0:
+            return
+        retry_after = await self.store.take(f"{rule}:{key}", limit, cost)
+        if retry_after:
+            self.rejected[rule] = self.rejected.get(rule, 0) + 1
+            raise _too_many(rule, retry_after)
+        self.admitted[rule] = self.admitted.get(rule, 0) + 1
+
+    def enter(self, route_class: str):
+        """Count a request in flight; raises 429 if it or the process is at its cap. Pair with leave()."""
+        for name in ("all", route_class):
+            cap = self.limits.get(name, 0)
+            if cap and self.in_flight[name] >= cap:
+                reason = f"in_flight_{name}"
+                self.rejected[reason] = self.rejected.get(reason, 0) + 1
+                raise _too_many(reason, 1)
+        self.in_flight["all"] += 1
+        if route_class in self.in_flight:
+            self.in_flight[route_class] += 1
+
+    def leave(self, route_class: str):
+        self.in_flight["all"] -= 1
+        if route_class in self.in_flight:
+            self.in_flight[route_class] -= 1
+
+    def stats(self) -> dict:
+        return {
+            **self.store.stats(),
+            "rules": {name: rule._asdict() for name, rule in self.rules.items()},
+            "limits": self.limits,
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+def _classify(path: str) -> Tuple[Optional[str], str]:
+    """(per-IP bucket rule, concurrency class) of a request path."""
+    if path.startswith("/api/send/"):
+        return "api", "send"
+    if path == "/api/auth/login":
+        return "login", "auth"
+    if path == "/api/auth/register":
+        return "register", "auth"
+    return "api", "api"
+
+
+def client_ip(scope, proxy_hops: int = ADMISSION_PROXY_HOPS) -> str:
+    """
+    Address the per-IP buckets are keyed by. Behind `proxy_hops` trusted proxies it is the
+    X-Forwarded-For entry that many places from the right, i.e. the peer the outermost
+    trusted proxy saw; entries further left come from the client and are ignored. Without
+    enough entries (the request skipped a proxy) the socket peer is used.
+    """
+    if proxy_hops > 0:
+        entries = [
+            entry.strip()
+            for value in Headers(scope=scope).getlist("x-forwarded-for")
+            for entry in value.split(",") if entry.strip()
+        ]
+        if len(entries) >= proxy_hops:
+            return entries[-proxy_hops]
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+class AdmissionMiddleware:
+    """Pure ASGI middleware; rejected requests are answered here without touching the route."""
+
+    def __init__(self, app, controller: Optional[AdmissionController] = None,
+                 excluded_paths: Tuple[str, ...] = EXCLUDED_PATHS):
+        self.app = app
+        self.controller = controller or admission
+        self.excluded_paths = excluded_paths
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or path.startswith(self.excluded_paths):
+            await self.app(scope, receive, send)
+            return
+        rule, route_class = _classify(path)
+        try:
+            self.controller.enter(route_class)
+        except HTTPException as e:
+            await _reject(send, e)
+            return
+        try:
+            await self.controller.admit(rule, client_ip(scope))
+        except HTTPException as e:
+            self.controller.leave(route_class)
+            await _reject(send, e)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.leave(route_class)
+
+
+async def _reject(send, error: HTTPException):
+    body = orjson.dumps({"detail": error.detail})
+    await send({
+        "type": "http.response.start",
+        "status": error.status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", error.headers["Retry-After"].encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+admission = AdmissionController(create_bucket_store(get_db))
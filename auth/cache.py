@@ -0,0 +1,6 @@
+from cache import TTLCache
+from config import PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL_SECONDS
+
+# Authenticated users keyed by token subject (username), so get_current_user does not hit
+# MongoDB on every request. Routes that change a user document invalidate its username.
+principal_cache = TTLCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL_SECONDS)
@@ -42,3 +42,12 @@ class UserOut(BaseModel):
         arbitrary_types_allowed=True,
         json_encoders={ObjectId: str},
     )
+
+
+# users.search_users result; built from SEARCH_PROJECTION documents, documents the API only
+class UserSearchResult(BaseModel):
+    user_id: str
+    username: str
+    first_name: str
+    last_name: str
+    is_online: bool = False
@@ -4,45 +4,57 @@ from datetime import timedelta
 from database import get_db
 from config import ACCESS_TOKEN_EXPIRE_MINUTES
 from auth.models import UserRegister, UserLogin, Token, User
-from auth.utils import get_password_hash, verify_password, create_access_token, get_current_user
+from auth.utils import password_hasher, create_access_token, get_current_user
+from auth.cache import principal_cache
+from chat.websocket import presence
+from users.search import search_keys, remember_user
+from projections import EXISTS_PROJECTION, LOGIN_PROJECTION
 
 router = APIRouter(prefix="/api/auth", tags=["Auth"])
 
 @router.post("/register", response_model=Token)
-async def register_user(user_data: UserRegister):
-    db = await get_db()
+async def register_user(user_data: UserRegister, db=Depends(get_db)):
     existing_user = await db.users.find_one({
         "$or": [{"username": user_data.username}, {"email": user_data.email}]
-    })
+    }, EXISTS_PROJECTION)
     if existing_user:
         raise HTTPException(status_code=400, detail="Username or email already registered")
 
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await password_hasher.hash(user_data.password)
 
     user_dict = user_data.model_dump()
     user_dict.pop("password")
     user = User(**user_dict)
     user_db = user.model_dump()
     user_db["password_hash"] = hashed_password
+    user_db["search_keys"] = search_keys(user.username, user.first_name, user.last_name)
     await db.users.insert_one(user_db)
+    remember_user(user_db)
 
     access_token = create_access_token(
-        data={"sub": user.username},
+        data={"sub": user.username, "uid": user.user_id},
         expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     )
     return {"access_token": access_token, "token_type": "bearer", "user_data": user.model_dump()}
 
 @router.post("/login", response_model=Token)
-async def login_user(credentials: UserLogin):
-    db = await get_db()
-    user = await db.users.find_one({"username": credentials.username})
-    if not user or not verify_password(credentials.password, user["password_hash"]):
+async def login_user(credentials: UserLogin, db=Depends(get_db)):
+    user = await db.users.find_one({"username": credentials.username}, LOGIN_PROJECTION)
+    if not user:
+        raise HTTPException(status_code=401, detail="Incorrect username or password")
+    valid, new_hash = await password_hasher.verify_and_update(credentials.password, user["password_hash"])
+    if not valid:
         raise HTTPException(status_code=401, detail="Incorrect username or password")
 
-    await db.users.update_one({"user_id": user["user_id"]}, {"$set": {"is_online": True}})
+    if new_hash:
+        # transparently upgrade to the current hash parameters
+        await db.users.update_one({"user_id": user["user_id"]}, {"$set": {"password_hash": new_hash}})
+    presence.heartbeat(user["user_id"])
+    user["is_online"] = True
+    principal_cache.invalidate(user["username"])
 
     access_token = create_access_token(
-        data={"sub": user["username"]},
+        data={"sub": user["username"], "uid": user["user_id"]},
         expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     )
 
@@ -54,6 +66,6 @@ async def login_user(credentials: UserLogin):
 
 @router.post("/logout")
 async def logout_user(current_user: UserOut = Depends(get_current_user)):
-    db = await get_db()
-    await db.users.update_one({"user_id": current_user.user_id}, {"$set": {"is_online": False}})
+    presence.offline(current_user.user_id)
+    principal_cache.invalidate(current_user.username)
     return {"message": "Successfully logged out"}
@@ -1,20 +1,66 @@
 from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+import asyncio
 import jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from config import SECRET_KEY, ALGORITHM
+from config import (
+    SECRET_KEY, ALGORITHM,
+    PASSWORD_HASH_ROUNDS, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING,
+)
 from database import get_db
 from auth.customPydantic import UserOut
+from auth.cache import principal_cache
+from projections import PRINCIPAL_PROJECTION
 
 security = HTTPBearer()
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+# Hashes with fewer rounds than configured are flagged for upgrade by verify_and_update
+pwd_context = CryptContext(
+    schemes=["pbkdf2_sha256"],
+    deprecated="auto",
+    pbkdf2_sha256__default_rounds=PASSWORD_HASH_ROUNDS,
+    pbkdf2_sha256__min_rounds=PASSWORD_HASH_ROUNDS,
+)
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+class PasswordHasher:
+    """
+    Runs pbkdf2 hashing on a bounded thread pool so it never blocks the event loop.
+    Once `max_pending` operations are queued or running, new ones are rejected with 503
+    instead of piling up behind a saturated pool.
+    """
+
+    def __init__(self, context: CryptContext, workers: int, max_pending: int):
+        self.context = context
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Server busy, try again", headers={"Retry-After": "1"})
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """Return (valid, new_hash); new_hash is set when the stored hash uses outdated parameters."""
+        return await self._run(self.context.verify_and_update, password, hashed_password)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+password_hasher = PasswordHasher(pwd_context, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
 
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -24,11 +70,16 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> UserOut:
-    db = await get_db()
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db=Depends(get_db)) -> UserOut:
+    return await authenticate_token(credentials.credentials, db)
+
+
+async def authenticate_token(token: str, db) -> UserOut:
+    """Resolve a bearer token to its user; shared by HTTP routes and the WebSocket handshake."""
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
+        user_id: str = payload.get("uid")
         if username is None:
             raise HTTPException(status_code=401, detail="Invalid credentials")
     except jwt.ExpiredSignatureError:
@@ -36,9 +87,15 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
-    user = await db.users.find_one({"username": username})
+    cached_user = principal_cache.get(username)
+    if cached_user is not None and (user_id is None or cached_user.user_id == user_id):
+        return cached_user
+
+    user = await db.users.find_one({"username": username}, PRINCIPAL_PROJECTION)
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
 
-    # ✅ Return UserOut instead of User
-    return UserOut(**user)
+    # ✅ Return UserOut instead of User; stored users were validated at registration
+    current_user = UserOut.model_construct(**user)
+    principal_cache.set(username, current_user)
+    return current_user
@@ -0,0 +1,294 @@
+"""
+End-to-end load test of main.app on an in-memory MongoDB stand-in (mongomock-motor).
+
+Boots the app with uvicorn on a free local port, then drives each hot path in turn:
+register, login, create chat, GET /api/chats, GET /api/users/search, POST /api/send
+(while --sse consumers stream GET /sse/{user_id}) and GET /api/chats/{id}/messages.
+
+For every phase it reports throughput, p50/p95/p99 latency and database operations per
+request; for sends it also reports send-to-delivery latency over SSE. Results are
+written as JSON (stdout or --output) so runs can be diffed across commits:
+
+    python benchmarks/app_load.py --output before.json
+    git checkout my-branch && python benchmarks/app_load.py --output after.json
+    diff <(jq .phases before.json) <(jq .phases after.json)
+
+Usage:
+    python benchmarks/app_load.py [--users 100] [--sse 200] [--messages 1000] [--concurrency 16] [--output FILE]
+"""
+import sys
+import json
+import time
+import socket
+import logging
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+import database  # noqa: E402
+
+# Collection methods that issue a database operation
+OPERATIONS = {
+    "find", "find_one", "find_one_and_update", "aggregate", "count_documents", "estimated_document_count",
+    "insert_one", "insert_many", "update_one", "update_many", "replace_one", "delete_one", "delete_many",
+    "bulk_write", "create_indexes",
+}
+
+
+class CountingCollection:
+    def __init__(self, collection, counter: Counter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in OPERATIONS:
+            return attr
+
+        def counted(*args, **kwargs):
+            self._counter[f"{self._collection.name}.{name}"] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+
+class CountingDatabase:
+    """Wraps the stand-in database so every collection operation is counted."""
+
+    def __init__(self, db, counter: Counter):
+        self._db = db
+        self._counter = counter
+
+    def __getitem__(self, name):
+        return CountingCollection(self._db[name], self._counter)
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        return CountingCollection(attr, self._counter) if hasattr(attr, "insert_one") else attr
+
+
+class CountingClient:
+    def __init__(self, counter: Counter):
+        self._client = AsyncMongoMockClient()
+        self._counter = counter
+
+    def __getitem__(self, name):
+        return CountingDatabase(self._client[name], self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def _percentiles(samples: list) -> dict:
+    samples = sorted(samples)
+    if not samples:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    pick = lambda fraction: round(samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000, 2)  # noqa: E731
+    return {"p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99)}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent.parent).stdout.strip()
+    except OSError:
+        return ""
+
+
+class Phase:
+    def __init__(self, name: str, counter: Counter):
+        self.name = name
+        self.counter = counter
+        self.latencies = []
+        self.errors = 0
+
+    async def run(self, calls, concurrency: int):
+        """Run request coroutines (factories) with bounded concurrency, timing each one."""
+        semaphore = asyncio.Semaphore(concurrency)
+        ops_before = sum(self.counter.values())
+        by_collection_before = Counter(self.counter)
+
+        async def timed(call):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await call()
+                    if response.status_code >= 400:
+                        self.errors += 1
+                    return response
+                finally:
+                    self.latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        responses = await asyncio.gather(*(timed(call) for call in calls))
+        self.elapsed = time.perf_counter() - started
+        self.ops = sum(self.counter.values()) - ops_before
+        self.ops_by_collection = dict(Counter(self.counter) - by_collection_before)
+        return responses
+
+    def result(self) -> dict:
+        requests = len(self.latencies)
+        return {
+            "requests": requests,
+            "errors": self.errors,
+            "throughput_rps": round(requests / self.elapsed, 1) if self.elapsed else None,
+            **_percentiles(self.latencies),
+            "db_ops_per_request": round(self.ops / requests, 2) if requests else None,
+            "db_ops": dict(sorted(self.ops_by_collection.items())),
+        }
+
+
+async def _consume(client: httpx.AsyncClient, user_id: str, ready: asyncio.Event, deliveries: list, stop: asyncio.Event):
+    async with client.stream("GET", f"/sse/{user_id}", timeout=None) as stream:
+        async for line in stream.aiter_lines():
+            if stop.is_set():
+                return
+            if not line.startswith("data: "):
+                continue
+            event = json.loads(line[6:])
+            if event.get("type") == "connected":
+                ready.set()
+            elif event.get("type") == "message" and "|" in event["content"]:
+                deliveries.append(time.perf_counter() - float(event["content"].split("|", 1)[0]))
+
+
+async def run(users: int, sse: int, messages: int, concurrency: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    counter: Counter = Counter()
+    database.client = CountingClient(counter)
+
+    from main import app
+    from erroremail import error_notifier, MemorySink
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # one INFO line per request otherwise
+    error_notifier.sink = MemorySink()  # never email from a benchmark
+    from admission import admission, Rule
+    # Every simulated user connects from 127.0.0.1; per-sender buckets and in-flight caps stay on
+    admission.rules.update(login=Rule(0, 0), register=Rule(0, 0), api=Rule(0, 0))
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    phases = {}
+    limits = httpx.Limits(max_connections=concurrency + sse + 8)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60, limits=limits) as client:
+        names = [f"bench{i:05d}" for i in range(users)]
+
+        phase = phases["register"] = Phase("register", counter)
+        await phase.run([
+            (lambda name=name: client.post("/api/auth/register", json={
+                "first_name": name.title(), "last_name": "Load", "mobile_no": "0000000000",
+                "email": f"{name}@example.com", "username": name,
+                "password": "bench-password", "security_phrase": "bench",
+            })) for name in names
+        ], concurrency)
+
+        phase = phases["login"] = Phase("login", counter)
+        responses = await phase.run([
+            (lambda name=name: client.post("/api/auth/login", json={"username": name, "password": "bench-password"}))
+            for name in names
+        ], concurrency)
+        accounts = [(r.json()["user_data"]["user_id"], {"Authorization": f"Bearer {r.json()['access_token']}"})
+                    for r in responses]
+
+        # Every user chats with the next three users in the ring
+        pairs = [(i, (i + step) % users) for i in range(users) for step in (1, 2, 3) if users > step]
+        phase = phases["create_chat"] = Phase("create_chat", counter)
+        responses = await phase.run([
+            (lambda a=a, b=b: client.post("/api/chats/create", params={"other_user_id": accounts[b][0]},
+                                          headers=accounts[a][1]))
+            for a, b in pairs
+        ], concurrency)
+        chats = [(a, b, r.json()["chat_id"]) for (a, b), r in zip(pairs, responses)]
+
+        # Open the SSE consumers, spread over the users
+        ready_events, deliveries, stop = [], [], asyncio.Event()
+        consumers = []
+        for i in range(sse):
+            ready = asyncio.Event()
+            ready_events.append(ready)
+            consumers.append(asyncio.create_task(_consume(client, accounts[i % users][0], ready, deliveries, stop)))
+        await asyncio.gather(*(ready.wait() for ready in ready_events))
+        await asyncio.sleep(0.05)
+
+        sends = [rng.choice(chats) for _ in range(messages)]
+        phase = phases["send"] = Phase("send", counter)
+        await phase.run([
+            (lambda a=a, chat_id=chat_id, i=i: client.post(
+                f"/api/send/{accounts[a][0]}",
+                json={"chat_id": chat_id, "content": f"{time.perf_counter()}|message {i}"},
+            ))
+            for i, (a, _, chat_id) in enumerate(sends)
+        ], concurrency)
+        # Wait for the fan-out to drain
+        expected = sum(sum(1 for c in range(sse) if c % users in (a, b)) for a, b, _ in sends)
+        deadline = time.perf_counter() + 10
+        while len(deliveries) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        stop.set()
+        for consumer in consumers:
+            consumer.cancel()
+        await asyncio.gather(*consumers, return_exceptions=True)
+
+        phase = phases["get_chats"] = Phase("get_chats", counter)
+        await phase.run([(lambda h=headers: client.get("/api/chats/", headers=h)) for _, headers in accounts], concurrency)
+
+        phase = phases["get_messages"] = Phase("get_messages", counter)
+        await phase.run([
+            (lambda a=a, chat_id=chat_id: client.get(f"/api/chats/{chat_id}/messages", headers=accounts[a][1]))
+            for a, _, chat_id in chats
+        ], concurrency)
+
+        phase = phases["search_users"] = Phase("search_users", counter)
+        await phase.run([
+            (lambda h=accounts[rng.randrange(users)][1], q=rng.choice(names)[:rng.randint(2, 8)]:
+                client.get("/api/users/search", params={"query": q}, headers=h))
+            for _ in range(users)
+        ], concurrency)
+
+    server.should_exit = True
+    await serving
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "database": "mongomock-motor",
+            "params": {"users": users, "sse": sse, "messages": messages, "concurrency": concurrency, "seed": seed},
+        },
+        "phases": {name: phase.result() for name, phase in phases.items()},
+        "delivery": {"expected": expected, "delivered": len(deliveries), **_percentiles(deliveries)},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--sse", type=int, default=200, help="concurrent /sse consumers")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+    results = asyncio.run(run(args.users, args.sse, args.messages, args.concurrency, args.seed))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
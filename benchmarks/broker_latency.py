@@ -0,0 +1,54 @@
+"""
+Publish-to-delivery latency of the chat fan-out brokers (chat/broker.py).
+
+The memory backend runs standalone; the mongo backend uses the database configured
+in .env and a scratch capped collection that is dropped afterwards.
+
+Usage:
+    python benchmarks/broker_latency.py [--backend memory|mongo] [--events 1000]
+"""
+import sys
+import json
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from chat.broker import InMemoryBroker, MongoCappedBroker  # noqa: E402
+from chat.sse import encode_event  # noqa: E402
+from database import get_db, close_db  # noqa: E402
+
+
+async def main(backend: str, events: int, interval: float):
+    if backend == "mongo":
+        broker = MongoCappedBroker(get_db, collection="chat_events_benchmark", size=4 * 1024 * 1024)
+    else:
+        broker = InMemoryBroker()
+
+    received = asyncio.Event()
+
+    async def handler(recipients, frame):
+        if frame.chat_id == str(events - 1):
+            received.set()
+
+    await broker.start(handler)
+    for seq in range(events):
+        await broker.publish(["user-a", "user-b"], encode_event({"type": "message", "chat_id": str(seq), "content": "x" * 64}))
+        await asyncio.sleep(interval)
+    await asyncio.wait_for(received.wait(), timeout=30)
+    await broker.stop()
+
+    if backend == "mongo":
+        await (await get_db()).drop_collection("chat_events_benchmark")
+        close_db()
+    print(json.dumps(broker.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backend", choices=["memory", "mongo"], default="memory")
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--interval", type=float, default=0.001, help="seconds between publishes")
+    args = parser.parse_args()
+    asyncio.run(main(args.backend, args.events, args.interval))
@@ -0,0 +1,97 @@
+"""
+Per-message CPU cost of fanning one broadcast out to every participant's stream.
+
+  per_recipient: the previous path, where each recipient's generator ran the recursive
+                 _serialize plus json.dumps on the same broadcast dict
+  encode_once:   ConnectionManager.deliver_local with one pre-encoded frame shared by all queues
+
+Usage:
+    python benchmarks/fanout_encoding.py [--messages 200]
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bson import ObjectId  # noqa: E402
+from chat.sse import encode_event  # noqa: E402
+from chat.broker import InMemoryBroker  # noqa: E402
+from chat.presence import PresenceService  # noqa: E402
+from chat.websocket import ConnectionManager  # noqa: E402
+from database import get_db  # noqa: E402
+
+PARTICIPANTS = [2, 50, 500]
+
+
+def _legacy_serialize(obj: dict) -> dict:
+    serialized = {}
+    for k, v in obj.items():
+        if isinstance(v, ObjectId):
+            serialized[k] = str(v)
+        elif hasattr(v, "isoformat"):
+            serialized[k] = v.isoformat()
+        elif isinstance(v, dict):
+            serialized[k] = _legacy_serialize(v)
+        else:
+            serialized[k] = v
+    return serialized
+
+
+def _broadcast(seq: int) -> dict:
+    return {
+        "type": "message",
+        "message_id": f"message-{seq}",
+        "chat_id": "chat-1",
+        "content": "Hello there! " * 8,
+        "timestamp": datetime.now().isoformat(),
+        "sender": {"user_id": "user-0", "username": "user0", "first_name": "User", "last_name": "Zero"},
+    }
+
+
+async def _encode_once(participants: int, messages: int) -> float:
+    manager = ConnectionManager(InMemoryBroker(), PresenceService(get_db))
+    connections = [await manager.connect(f"user-{i}") for i in range(participants)]
+    recipients = [c.user_id for c in connections]
+    started = time.process_time()
+    for seq in range(messages):
+        await manager.deliver_local(recipients, encode_event(_broadcast(seq)))
+        for connection in connections:
+            (await connection.get()).data
+    return (time.process_time() - started) / messages
+
+
+async def _per_recipient(participants: int, messages: int) -> float:
+    queues = [asyncio.Queue() for _ in range(participants)]
+    started = time.process_time()
+    for seq in range(messages):
+        message = _broadcast(seq)
+        for queue in queues:
+            queue.put_nowait(message)
+        for queue in queues:
+            f"data: {json.dumps(_legacy_serialize(await queue.get()))}\n\n".encode()
+    return (time.process_time() - started) / messages
+
+
+async def main(messages: int):
+    results = []
+    for participants in PARTICIPANTS:
+        for mode, run in (("per_recipient", _per_recipient), ("encode_once", _encode_once)):
+            cpu = await run(participants, messages)
+            results.append({
+                "mode": mode,
+                "participants": participants,
+                "cpu_us_per_message": round(cpu * 1e6, 1),
+            })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.messages))
@@ -0,0 +1,97 @@
+"""
+Sender wait, delivery latency and longest event-loop stall of one group message.
+
+  inline:    the previous path, where the sender's request published to every member
+             before returning
+  scheduled: chat.fanout.FanoutScheduler, where the request only queues the event and
+             the shard worker publishes it in batches of --batch-size members
+
+Every member has one open stream on this process (InMemoryBroker, so no MongoDB needed).
+The stall is the longest gap seen by a task that keeps yielding to the event loop, i.e.
+how long other requests could be held up by the fan-out.
+
+Usage:
+    python benchmarks/group_fanout.py [--messages 20] [--batch-size 500] [--concurrency 4]
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from chat.sse import encode_event  # noqa: E402
+from chat.broker import InMemoryBroker  # noqa: E402
+from chat.fanout import FanoutScheduler  # noqa: E402
+from chat.presence import PresenceService  # noqa: E402
+from chat.websocket import ConnectionManager  # noqa: E402
+from database import get_db  # noqa: E402
+
+GROUP_SIZES = [2, 500, 5000]
+
+
+async def _stall_monitor(stop: asyncio.Event, gaps: list):
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(0)
+        now = time.perf_counter()
+        gaps.append(now - last)
+        last = now
+
+
+async def _run(mode: str, members: int, messages: int, batch_size: int, concurrency: int) -> dict:
+    broker = InMemoryBroker()
+    manager = ConnectionManager(broker, PresenceService(get_db))
+    await broker.start(manager.deliver_local)
+    scheduler = FanoutScheduler(broker.publish, batch_size=batch_size, concurrency=concurrency)
+    connections = [await manager.connect(f"user-{i}") for i in range(members)]
+    recipients = [c.user_id for c in connections]
+
+    stop, gaps = asyncio.Event(), []
+    monitor = asyncio.create_task(_stall_monitor(stop, gaps))
+    waits, latencies = [], []
+    for seq in range(messages):
+        frame = encode_event({"type": "message", "chat_id": "group-1", "content": f"message {seq}"})
+        started = time.perf_counter()
+        if mode == "inline":
+            await broker.publish(recipients, frame)
+        else:
+            scheduler.submit(recipients, frame)
+        waits.append(time.perf_counter() - started)
+        while any(c.queue.empty() for c in connections):
+            await asyncio.sleep(0.0005)
+        latencies.append(time.perf_counter() - started)
+        for connection in connections:
+            connection.queue.get_nowait()
+        await asyncio.sleep(0.001)
+    stop.set()
+    await monitor
+    await scheduler.stop()
+
+    return {
+        "mode": mode,
+        "members": members,
+        "sender_wait_ms_max": round(max(waits) * 1000, 3),
+        "delivered_ms_p50": round(sorted(latencies)[len(latencies) // 2] * 1000, 2),
+        "delivered_ms_max": round(max(latencies) * 1000, 2),
+        "loop_stall_ms_max": round(max(gaps) * 1000, 2),
+    }
+
+
+async def main(messages: int, batch_size: int, concurrency: int):
+    results = []
+    for members in GROUP_SIZES:
+        for mode in ("inline", "scheduled"):
+            results.append(await _run(mode, members, messages, batch_size, concurrency))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+    asyncio.run(main(args.messages, args.batch_size, args.concurrency))
@@ -0,0 +1,77 @@
+"""
+Login throughput microbenchmark: password verification inline on the event loop
+versus offloaded to the bounded hashing pool (auth.utils.password_hasher).
+
+Besides logins/sec it reports event-loop lag, i.e. how long other coroutines
+(SSE streams, sends) are starved while logins run.
+
+Usage:
+    python benchmarks/login_throughput.py [--logins 200] [--concurrency 32]
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from auth.utils import pwd_context, password_hasher  # noqa: E402
+
+TICK = 0.005
+
+
+async def _lag_sampler(samples: list, stop: asyncio.Event):
+    """Sleep for TICK repeatedly and record how late each wake-up is."""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        samples.append(time.perf_counter() - started - TICK)
+
+
+async def _run(mode: str, stored_hash: str, logins: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def login():
+        async with semaphore:
+            if mode == "inline":
+                pwd_context.verify_and_update("password123", stored_hash)
+            else:
+                await password_hasher.verify_and_update("password123", stored_hash)
+
+    lag, stop = [], asyncio.Event()
+    sampler = asyncio.create_task(_lag_sampler(lag, stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await sampler
+
+    lag.sort()
+    return {
+        "mode": mode,
+        "logins": logins,
+        "concurrency": concurrency,
+        "logins_per_sec": round(logins / elapsed, 1),
+        "loop_lag_p99_ms": round(lag[int(len(lag) * 0.99) - 1] * 1000, 2) if lag else None,
+        "loop_lag_max_ms": round(lag[-1] * 1000, 2) if lag else None,
+    }
+
+
+async def main(logins: int, concurrency: int):
+    stored_hash = pwd_context.hash("password123")
+    results = [
+        await _run("inline", stored_hash, logins, concurrency),
+        await _run("offload", stored_hash, logins, concurrency),
+    ]
+    password_hasher.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+    asyncio.run(main(args.logins, min(args.concurrency, password_hasher.max_pending)))
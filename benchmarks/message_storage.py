@@ -0,0 +1,151 @@
+"""
+Storage size and history-read latency of the message storage engines (chat/store.py).
+
+  documents: one document per message (MESSAGE_STORAGE=documents)
+  buckets:   per-chat time-window buckets, before and after compacting them into
+             compressed blocks (MESSAGE_STORAGE=buckets)
+
+Messages are spread over the last --days days. Reads page through history with the
+same keyset positions the API uses: the newest page and pages before random messages.
+Sizes come from collStats on MongoDB (scratch database <db_name>_storage_benchmark,
+dropped afterwards); with --mock (mongomock) only BSON document sizes are reported.
+
+Usage:
+    python benchmarks/message_storage.py [--chats 20] [--messages 20000] [--days 30] [--page 100] [--reads 200] [--mock]
+"""
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bson  # noqa: E402
+from chat.store import BucketStore, DocumentStore  # noqa: E402
+from indexes import INDEXES  # noqa: E402
+
+WORDS = ["ok", "see you", "lol", "on my way", "did you see the game last night?", "call me",
+         "sounds good", "what time?", "sure", "thanks!", "running late, 10 min"]
+
+
+def _messages(rng: random.Random, chats: int, per_chat: int, days: int) -> list:
+    now = datetime.now().replace(microsecond=0)
+    messages = []
+    for _ in range(chats):
+        chat_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        senders = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(2)]
+        offsets = sorted(rng.uniform(0, days * 86400) for _ in range(per_chat))
+        for offset in offsets:
+            messages.append({
+                "message_id": str(uuid.UUID(int=rng.getrandbits(128))),
+                "chat_id": chat_id,
+                "sender_id": rng.choice(senders),
+                "content": rng.choice(WORDS),
+                "timestamp": now - timedelta(seconds=days * 86400 - offset),
+                "message_type": "text",
+            })
+    return messages
+
+
+def _percentiles(samples: list) -> dict:
+    samples = sorted(samples)
+    pick = lambda fraction: round(samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000, 3)  # noqa: E731
+    return {"p50_ms": pick(0.50), "p95_ms": pick(0.95)}
+
+
+async def _size(db, collection: str, mock: bool) -> dict:
+    if not mock:
+        stats = await db.command("collStats", collection)
+        return {
+            "documents": stats["count"],
+            "data_bytes": stats["size"],
+            "storage_bytes": stats["storageSize"],
+            "index_bytes": stats["totalIndexSize"],
+        }
+    documents, data_bytes = 0, 0
+    async for document in db[collection].find({}):
+        documents += 1
+        data_bytes += len(bson.encode(document))
+    return {"documents": documents, "data_bytes": data_bytes}
+
+
+async def _reads(db, store, messages: list, page: int, reads: int, rng: random.Random) -> dict:
+    chat_ids = sorted({m["chat_id"] for m in messages})
+    by_chat = {chat_id: [] for chat_id in chat_ids}
+    for message in messages:
+        by_chat[message["chat_id"]].append(message)
+
+    newest, deep = [], []
+    for _ in range(reads):
+        chat_id = rng.choice(chat_ids)
+        started = time.perf_counter()
+        await store.page(db, chat_id, limit=page)
+        newest.append(time.perf_counter() - started)
+
+        anchor = rng.choice(by_chat[chat_id])
+        started = time.perf_counter()
+        await store.page(db, chat_id, before=(anchor["timestamp"], anchor["message_id"]), limit=page)
+        deep.append(time.perf_counter() - started)
+    return {"newest_page": _percentiles(newest), "older_page": _percentiles(deep)}
+
+
+async def main(chats: int, per_chat: int, days: int, page: int, reads: int, mock: bool):
+    rng = random.Random(42)
+    messages = _messages(rng, chats, per_chat, days)
+    if mock:
+        from mongomock_motor import AsyncMongoMockClient
+        client = AsyncMongoMockClient()
+        db = client["storage_benchmark"]
+    else:
+        import database
+        from config import db_name
+        database.connect_db()
+        client = database.client
+        db = client[f"{db_name}_storage_benchmark"]
+    await db.messages.create_indexes(INDEXES["messages"])
+    await db.message_buckets.create_indexes(INDEXES["message_buckets"])
+
+    results = {"params": {"chats": chats, "messages_per_chat": per_chat, "days": days, "page": page,
+                          "database": "mongomock" if mock else "mongodb"}}
+    try:
+        for name, store in (("documents", DocumentStore()), ("buckets", BucketStore())):
+            started = time.perf_counter()
+            for i in range(0, len(messages), 1000):
+                await store.insert(db, messages[i:i + 1000])
+            insert_seconds = time.perf_counter() - started
+            collection = "messages" if name == "documents" else "message_buckets"
+            results[name] = {
+                "insert_msgs_per_s": round(len(messages) / insert_seconds),
+                "size": await _size(db, collection, mock),
+                **await _reads(db, store, messages, page, reads, random.Random(7)),
+            }
+            if isinstance(store, BucketStore):
+                started = time.perf_counter()
+                windows = await store.compact(db)
+                results["buckets_compacted"] = {
+                    "windows": windows,
+                    "compact_seconds": round(time.perf_counter() - started, 2),
+                    "size": await _size(db, collection, mock),
+                    **await _reads(db, store, messages, page, reads, random.Random(7)),
+                }
+    finally:
+        await client.drop_database(db.name)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=20000, help="messages per chat")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--page", type=int, default=100)
+    parser.add_argument("--reads", type=int, default=200)
+    parser.add_argument("--mock", action="store_true", help="run on mongomock (no collStats)")
+    args = parser.parse_args()
+    asyncio.run(main(args.chats, args.messages, args.days, args.page, args.reads, args.mock))
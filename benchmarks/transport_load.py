@@ -0,0 +1,154 @@
+"""
+Load test comparing the two real-time transports against a running server:
+
+  rest_sse:  each message is POST /api/send/{user_id}, delivered over GET /sse/{user_id}
+  websocket: messages are sent and delivered over /ws
+
+Reports messages/sec and send-to-delivery latency percentiles for each.
+
+Usage:
+    uvicorn main:app --port 8001
+    python benchmarks/transport_load.py --base-url http://localhost:8001 [--messages 500] [--concurrency 8]
+"""
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import httpx
+import websockets
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 2) if values else None
+
+
+async def _register(client: httpx.AsyncClient, name: str) -> dict:
+    username = f"{name}-{uuid.uuid4().hex[:8]}"
+    response = await client.post("/api/auth/register", json={
+        "first_name": name, "last_name": "Bench", "mobile_no": "0000000000",
+        "email": f"{username}@example.com", "username": username,
+        "password": "bench-password", "security_phrase": "bench",
+    })
+    response.raise_for_status()
+    body = response.json()
+    return {"token": body["access_token"], "user_id": body["user_data"]["user_id"]}
+
+
+async def _setup(client: httpx.AsyncClient):
+    sender, receiver = await _register(client, "sender"), await _register(client, "receiver")
+    response = await client.post(
+        "/api/chats/create", params={"other_user_id": receiver["user_id"]},
+        headers={"Authorization": f"Bearer {sender['token']}"},
+    )
+    response.raise_for_status()
+    return sender, receiver, response.json()["chat_id"]
+
+
+def _result(transport, messages, elapsed, latencies):
+    return {
+        "transport": transport,
+        "messages": messages,
+        "delivered": len(latencies),
+        "messages_per_sec": round(len(latencies) / elapsed, 1),
+        "latency_ms_p50": _percentile(latencies, 0.50),
+        "latency_ms_p99": _percentile(latencies, 0.99),
+    }
+
+
+async def _send_all(messages: int, concurrency: int, send_one):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(seq):
+        async with semaphore:
+            await send_one(f"{seq}:{time.perf_counter()}")
+
+    await asyncio.gather(*(bounded(seq) for seq in range(messages)))
+
+
+async def run_rest_sse(client: httpx.AsyncClient, messages: int, concurrency: int) -> dict:
+    sender, receiver, chat_id = await _setup(client)
+    latencies, done, ready = [], asyncio.Event(), asyncio.Event()
+
+    async def consume():
+        async with client.stream("GET", f"/sse/{receiver['user_id']}", timeout=None) as stream:
+            async for line in stream.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[6:])
+                if event.get("type") == "connected":
+                    ready.set()
+                elif event.get("type") == "message":
+                    latencies.append(time.perf_counter() - float(event["content"].split(":", 1)[1]))
+                    if len(latencies) == messages:
+                        done.set()
+                        return
+
+    async def send_one(content):
+        response = await client.post(f"/api/send/{sender['user_id']}", json={"chat_id": chat_id, "content": content})
+        response.raise_for_status()
+
+    consumer = asyncio.create_task(consume())
+    await ready.wait()
+    started = time.perf_counter()
+    await _send_all(messages, concurrency, send_one)
+    await asyncio.wait_for(done.wait(), timeout=60)
+    elapsed = time.perf_counter() - started
+    consumer.cancel()
+    return _result("rest_sse", messages, elapsed, latencies)
+
+
+async def run_websocket(client: httpx.AsyncClient, ws_url: str, messages: int, concurrency: int) -> dict:
+    sender, receiver, chat_id = await _setup(client)
+    latencies, done = [], asyncio.Event()
+
+    async with websockets.connect(f"{ws_url}/ws?token={receiver['token']}") as receiver_ws, \
+            websockets.connect(f"{ws_url}/ws?token={sender['token']}") as sender_ws:
+        await receiver_ws.recv()
+        await sender_ws.recv()
+
+        async def consume():
+            async for raw in receiver_ws:
+                event = json.loads(raw)
+                if event.get("type") == "message":
+                    latencies.append(time.perf_counter() - float(event["content"].split(":", 1)[1]))
+                    if len(latencies) == messages:
+                        done.set()
+                        return
+
+        async def drain_acks():
+            async for _ in sender_ws:
+                pass
+
+        async def send_one(content):
+            await sender_ws.send(json.dumps({"type": "send", "chat_id": chat_id, "content": content}))
+
+        tasks = [asyncio.create_task(consume()), asyncio.create_task(drain_acks())]
+        started = time.perf_counter()
+        await _send_all(messages, concurrency, send_one)
+        await asyncio.wait_for(done.wait(), timeout=60)
+        elapsed = time.perf_counter() - started
+        for task in tasks:
+            task.cancel()
+    return _result("websocket", messages, elapsed, latencies)
+
+
+async def main(base_url: str, messages: int, concurrency: int):
+    ws_url = base_url.replace("http://", "ws://").replace("https://", "wss://")
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+        results = [
+            await run_rest_sse(client, messages, concurrency),
+            await run_websocket(client, ws_url, messages, concurrency),
+        ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:8001")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.base_url, args.messages, args.concurrency)))
@@ -0,0 +1,132 @@
+"""
+p95 latency of user search at 10k, 100k and 1M users.
+
+  regex:  the previous unanchored case-insensitive $regex over username, first_name, last_name
+  prefix: anchored prefix query on the search_keys index (USER_SEARCH_BACKEND=mongo)
+  memory: in-process PrefixIndex lookup (USER_SEARCH_BACKEND=memory), without the document fetch
+
+The mongo backends use the database configured in .env and a scratch collection that
+is dropped afterwards; `--backend memory` runs standalone.
+
+Usage:
+    python benchmarks/user_search.py [--backend all|mongo|memory] [--sizes 10000,100000,1000000] [--queries 200]
+"""
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pymongo import IndexModel, ASCENDING  # noqa: E402
+from users.search import SEARCH_LIMIT, SEARCH_PROJECTION, PrefixIndex, normalize, search_keys  # noqa: E402
+
+COLLECTION = "users_search_benchmark"
+SYLLABLES = ["an", "be", "ca", "do", "el", "fi", "ga", "ho", "ir", "ja", "ka", "lo", "ma", "ne", "or", "pa",
+             "ri", "sa", "to", "ul", "va", "yo", "za"]
+
+
+def _name(rng: random.Random) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).title()
+
+
+def _user(rng: random.Random, seq: int) -> dict:
+    first, last = _name(rng), _name(rng)
+    username = f"{first.lower()}{seq}"
+    return {
+        "user_id": f"user-{seq}",
+        "username": username,
+        "first_name": first,
+        "last_name": last,
+        "password_hash": "x" * 87,
+        "search_keys": search_keys(username, first, last),
+    }
+
+
+def _queries(rng: random.Random, count: int) -> list:
+    return [_name(rng)[:rng.randint(2, 5)] for _ in range(count)]
+
+
+def _p95(samples: list) -> float:
+    samples = sorted(samples)
+    return round(samples[int(len(samples) * 0.95) - 1] * 1000, 3)
+
+
+async def _timed(run, queries: list) -> float:
+    samples = []
+    for query in queries:
+        started = time.perf_counter()
+        await run(query)
+        samples.append(time.perf_counter() - started)
+    return _p95(samples)
+
+
+async def main(backend: str, sizes: list, query_count: int):
+    rng = random.Random(42)
+    queries = _queries(rng, query_count)
+    results = []
+    users = []
+    collection = None
+    if backend in ("all", "mongo"):
+        from database import get_db
+        collection = (await get_db())[COLLECTION]
+        await collection.drop()
+        await collection.create_indexes([IndexModel([("search_keys", ASCENDING)])])
+
+    try:
+        for size in sizes:
+            batch = [_user(rng, seq) for seq in range(len(users), size)]
+            users.extend(batch)
+
+            if collection is not None:
+                for i in range(0, len(batch), 10000):
+                    await collection.insert_many(batch[i:i + 10000], ordered=False)
+
+                async def regex(query):
+                    await collection.find({"$or": [
+                        {"username": {"$regex": query, "$options": "i"}},
+                        {"first_name": {"$regex": query, "$options": "i"}},
+                        {"last_name": {"$regex": query, "$options": "i"}},
+                    ]}).to_list(SEARCH_LIMIT)
+
+                async def prefix(query):
+                    await collection.find(
+                        {"search_keys": {"$regex": f"^{re.escape(normalize(query))}"}}, SEARCH_PROJECTION
+                    ).limit(SEARCH_LIMIT).to_list(SEARCH_LIMIT)
+
+                results.append({"users": size, "mode": "regex", "p95_ms": await _timed(regex, queries)})
+                results.append({"users": size, "mode": "prefix", "p95_ms": await _timed(prefix, queries)})
+
+            if backend in ("all", "memory"):
+                index = PrefixIndex()
+                started = time.perf_counter()
+                index.load([(user["user_id"], user["search_keys"]) for user in users])
+                load_seconds = time.perf_counter() - started
+
+                async def memory(query):
+                    index.search(normalize(query))
+
+                results.append({
+                    "users": size, "mode": "memory", "p95_ms": await _timed(memory, queries),
+                    "load_seconds": round(load_seconds, 2),
+                })
+    finally:
+        if collection is not None:
+            await collection.drop()
+            from database import close_db
+            close_db()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backend", choices=["all", "mongo", "memory"], default="all")
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.backend, [int(size) for size in args.sizes.split(",")], args.queries))
@@ -0,0 +1,161 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, List, Optional
+from bson import ObjectId
+from pymongo import CursorType, ReturnDocument
+from pymongo.errors import CollectionInvalid, PyMongoError
+from chat.sse import Frame, build_frame, set_worker_slot
+from config import CHAT_BROKER, CHAT_EVENTS_COLLECTION, CHAT_EVENTS_COLLECTION_SIZE
+
+# Called by the broker for every published event: handler(recipients, frame)
+Handler = Callable[[List[str], Frame], Awaitable[None]]
+
+
+class Broker:
+    """
+    Fans chat events out to every app process. Each process subscribes once with a
+    handler that delivers to its own local queues; `publish` may be called from any process.
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self._handler: Optional[Handler] = None
+        self._latencies = deque(maxlen=1000)
+        self.published = 0
+        self.delivered = 0
+
+    async def start(self, handler: Handler):
+        self._handler = handler
+
+    async def stop(self):
+        self._handler = None
+
+    async def publish(self, recipients: List[str], frame: Frame):
+        raise NotImplementedError
+
+    async def _dispatch(self, recipients: List[str], frame: Frame, published_at: float):
+        if self._handler is None:
+            return
+        await self._handler(recipients, frame)
+        self.delivered += 1
+        self._latencies.append(time.time() - published_at)
+
+    def stats(self) -> dict:
+        """Publish-to-local-delivery latency over the most recent events."""
+        latencies = sorted(self._latencies)
+        return {
+            "backend": self.name,
+            "published": self.published,
+            "delivered": self.delivered,
+            "latency_ms_p50": round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+            "latency_ms_p99": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2) if latencies else None,
+            "latency_ms_max": round(latencies[-1] * 1000, 2) if latencies else None,
+        }
+
+
+class InMemoryBroker(Broker):
+    """Single-process broker: publishing delivers straight to the local handler."""
+
+    name = "memory"
+
+    async def publish(self, recipients: List[str], frame: Frame):
+        self.published += 1
+        await self._dispatch(recipients, frame, time.time())
+
+
+class MongoCappedBroker(Broker):
+    """
+    Multi-process broker on a capped collection. `publish` inserts an event document
+    and every process tails the collection with a tailable-await cursor.
+    """
+
+    name = "mongo"
+
+    def __init__(self, get_db, collection: str = CHAT_EVENTS_COLLECTION, size: int = CHAT_EVENTS_COLLECTION_SIZE):
+        super().__init__()
+        self._get_db = get_db
+        self.collection_name = collection
+        self.size = size
+        self._collection = None
+        self._task: Optional[asyncio.Task] = None
+        self._recent = deque(maxlen=1000)  # ids already dispatched, for cursor restarts
+
+    async def start(self, handler: Handler):
+        await super().start(handler)
+        db = await self._get_db()
+        try:
+            await db.create_collection(self.collection_name, capped=True, size=self.size)
+        except CollectionInvalid:
+            pass  # already exists
+        self._collection = db[self.collection_name]
+        # Every worker that starts takes the next slot, so their event ids never collide
+        counter = await db.counters.find_one_and_update(
+            {"_id": "event_id_worker"}, {"$inc": {"seq": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        set_worker_slot(counter["seq"])
+        last = await self._collection.find_one({}, {"_id": 1}, sort=[("$natural", -1)])
+        last_id = last["_id"] if last else None
+        if last_id:
+            # Only events published after startup are delivered
+            async for event in self._collection.find(
+                {"_id": {"$gte": ObjectId.from_datetime(last_id.generation_time)}}, {"_id": 1}
+            ):
+                self._recent.append(event["_id"])
+        self._task = asyncio.create_task(self._tail(last_id))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await super().stop()
+
+    async def publish(self, recipients: List[str], frame: Frame):
+        self.published += 1
+        await self._collection.insert_one({
+            "recipients": recipients,
+            "payload": frame.json,
+            "chat_id": frame.chat_id,
+            "event_id": frame.event_id,
+            "event_type": frame.event_type,
+            "published_at": time.time(),
+        })
+
+    async def _tail(self, last_id: Optional[ObjectId]):
+        while True:
+            # ObjectIds from different processes are not ordered within one second, so a
+            # restarted cursor resumes from the start of that second and skips seen ids
+            query = {"_id": {"$gte": ObjectId.from_datetime(last_id.generation_time)}} if last_id else {}
+            cursor = self._collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+            try:
+                while cursor.alive:
+                    async for event in cursor:
+                        last_id = event["_id"]
+                        if last_id in self._recent:
+                            continue
+                        self._recent.append(last_id)
+                        try:
+                            await self._dispatch(
+                                event["recipients"],
+                                build_frame(event["payload"], event.get("chat_id"), event.get("event_id"),
+                                            event.get("event_type")),
+                                event["published_at"],
+                            )
+                        except Exception as e:
+                            logging.error(f"Chat event delivery failed: {e}")
+            except PyMongoError as e:
+                logging.error(f"Chat event cursor failed: {e}")
+            # Tailable cursors die on an empty collection or a network error; back off and retry
+            await asyncio.sleep(0.5)
+
+
+def create_broker(get_db) -> Broker:
+    if CHAT_BROKER == "mongo":
+        return MongoCappedBroker(get_db)
+    return InMemoryBroker()
@@ -0,0 +1,64 @@
+from typing import Dict, Iterable, List, Optional
+from cache import TTLCache
+from config import CHAT_CACHE_SIZE, CHAT_CACHE_TTL_SECONDS
+from projections import MEMBER_PROJECTION, USER_SUMMARY_PROJECTION as SENDER_PROJECTION
+
+# chat_id -> participant user_ids
+membership_cache = TTLCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL_SECONDS)
+# user_id -> sender summary (SENDER_PROJECTION fields)
+sender_cache = TTLCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL_SECONDS)
+
+
+def remember_participants(chat_id: str, participants: List[str]):
+    membership_cache.set(chat_id, list(participants))
+
+
+def forget_participants(chat_id: str):
+    membership_cache.invalidate(chat_id)
+
+
+async def get_participants(db, chat_id: str) -> Optional[List[str]]:
+    """
+    Participants of a chat, or None if the chat does not exist. Direct chats list them
+    in the chat document; group members are the users with a chat summary for it.
+    """
+    participants = membership_cache.get(chat_id)
+    if participants is None:
+        chat = await db.chats.find_one({"chat_id": chat_id}, {"_id": 0, "participants": 1, "is_group": 1})
+        if not chat:
+            return None
+        if chat.get("is_group"):
+            participants = [
+                member["user_id"]
+                async for member in db.chat_summaries.find({"chat_id": chat_id}, MEMBER_PROJECTION)
+            ]
+        else:
+            participants = chat.get("participants", [])
+        remember_participants(chat_id, participants)
+    return participants
+
+
+async def get_sender_summary(db, user_id: str) -> Optional[dict]:
+    """The public fields of a user shown next to their messages."""
+    sender = sender_cache.get(user_id)
+    if sender is None:
+        sender = await db.users.find_one({"user_id": user_id}, SENDER_PROJECTION)
+        if sender:
+            sender_cache.set(user_id, sender)
+    return sender
+
+
+async def get_sender_summaries(db, user_ids: Iterable[str]) -> Dict[str, dict]:
+    """Sender summaries by user_id: cached ones directly, the rest in one round trip."""
+    senders, missing = {}, []
+    for user_id in set(user_ids):
+        sender = sender_cache.get(user_id)
+        if sender is None:
+            missing.append(user_id)
+        else:
+            senders[user_id] = sender
+    if missing:
+        async for sender in db.users.find({"user_id": {"$in": missing}}, SENDER_PROJECTION):
+            sender_cache.set(sender["user_id"], sender)
+            senders[sender["user_id"]] = sender
+    return senders
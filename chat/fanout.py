@@ -0,0 +1,114 @@
+"""
+Fan-out scheduler: delivers chat events off the sender's request path.
+
+`submit` only appends the event to a queue. Queues are sharded by chat_id over
+FANOUT_SHARDS worker tasks, so the events of one chat reach every member in order
+while different chats fan out in parallel. A worker splits the recipients of an
+event into batches of FANOUT_BATCH_SIZE and publishes up to FANOUT_CONCURRENCY
+batches at once, so sending to a 5,000-member group costs the sender the same as
+sending to two users, and no single batch holds the event loop for long.
+"""
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, List, Optional, Tuple
+from fastapi import HTTPException
+from chat.sse import Frame
+from config import FANOUT_SHARDS, FANOUT_BATCH_SIZE, FANOUT_CONCURRENCY, FANOUT_MAX_PENDING
+
+# publish(recipients, frame), i.e. Broker.publish
+Publish = Callable[[List[str], Frame], Awaitable[None]]
+
+
+class FanoutScheduler:
+    def __init__(self, publish: Publish, shards: int = FANOUT_SHARDS, batch_size: int = FANOUT_BATCH_SIZE,
+                 concurrency: int = FANOUT_CONCURRENCY, max_pending: int = FANOUT_MAX_PENDING):
+        self.publish = publish
+        self.shards = max(1, shards)
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.max_pending = max_pending
+        # One queue per shard of (recipients, frame, submitted_at); None stops the worker
+        self._queues: List[asyncio.Queue] = []
+        self._workers: List[asyncio.Task] = []
+        self._latencies = deque(maxlen=1000)
+        self.pending = 0
+        self.submitted = 0
+        self.delivered = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.rejected = 0
+
+    def start(self):
+        if not self._workers:
+            self._queues = [asyncio.Queue() for _ in range(self.shards)]
+            self._workers = [asyncio.create_task(self._run(queue)) for queue in self._queues]
+
+    async def stop(self):
+        """Deliver what is already queued, then stop the workers."""
+        if self._workers:
+            for queue in self._queues:
+                queue.put_nowait(None)
+            await asyncio.gather(*self._workers)
+            self._workers = []
+
+    def admit(self):
+        """Reject new sends with 503 while the queues hold more than max_pending events."""
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Server busy, try again", headers={"Retry-After": "1"})
+
+    def submit(self, recipients: List[str], frame: Frame):
+        """Queue an event for delivery to `recipients`; returns immediately."""
+        if not recipients:
+            return
+        self.start()
+        self.pending += 1
+        self.submitted += 1
+        shard = hash(frame.chat_id) % self.shards
+        self._queues[shard].put_nowait((recipients, frame, time.monotonic()))
+
+    async def _run(self, queue: asyncio.Queue):
+        while True:
+            job: Optional[Tuple[List[str], Frame, float]] = await queue.get()
+            if job is None:
+                return
+            recipients, frame, submitted_at = job
+            try:
+                await self._deliver(recipients, frame)
+            finally:
+                self.pending -= 1
+            self.delivered += 1
+            self._latencies.append(time.monotonic() - submitted_at)
+
+    async def _deliver(self, recipients: List[str], frame: Frame):
+        batches = [recipients[i:i + self.batch_size] for i in range(0, len(recipients), self.batch_size)]
+        for i in range(0, len(batches), self.concurrency):
+            await asyncio.gather(*(self._publish_batch(batch, frame) for batch in batches[i:i + self.concurrency]))
+
+    async def _publish_batch(self, recipients: List[str], frame: Frame):
+        try:
+            await self.publish(recipients, frame)
+            self.batches += 1
+        except Exception as e:
+            self.failed_batches += 1
+            logging.error(f"Fan-out of chat {frame.chat_id} to {len(recipients)} recipients failed: {e}")
+
+    def stats(self) -> dict:
+        """Queue depth and submit-to-last-batch latency over the most recent events."""
+        latencies = sorted(self._latencies)
+        return {
+            "shards": self.shards,
+            "batch_size": self.batch_size,
+            "concurrency": self.concurrency,
+            "pending": self.pending,
+            "submitted": self.submitted,
+            "delivered": self.delivered,
+            "batches": self.batches,
+            "failed_batches": self.failed_batches,
+            "rejected": self.rejected,
+            "latency_ms_p50": round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+            "latency_ms_p99": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2) if latencies else None,
+            "latency_ms_max": round(latencies[-1] * 1000, 2) if latencies else None,
+        }
@@ -5,10 +5,23 @@ import uuid
 
 class Chat(BaseModel):
     chat_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    participants: List[str]
+    participants: List[str] = Field(default_factory=list)  # direct chats; group members are their chat_summaries
+    is_group: bool = False
+    name: Optional[str] = None  # groups only
+    created_by: Optional[str] = None  # groups only
+    member_count: Optional[int] = None  # groups only
     created_at: datetime = Field(default_factory=datetime.now)
     last_message: Optional[str] = None
     last_message_time: Optional[datetime] = None
+    last_sender_id: Optional[str] = None
+    last_activity: Optional[datetime] = None  # last_message_time, or created_at until the first message
+
+class GroupCreate(BaseModel):
+    name: str = Field(..., min_length=1, max_length=100)
+    member_ids: List[str] = Field(default_factory=list)  # besides the creator
+
+class MemberChange(BaseModel):
+    user_ids: List[str] = Field(..., min_length=1)
 
 class Message(BaseModel):
     message_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -17,3 +30,44 @@ class Message(BaseModel):
     content: str
     timestamp: datetime = Field(default_factory=datetime.now)
     message_type: str = "text"
+
+
+# Response shapes. Handlers build these as plain dicts from projected documents and
+# return them pre-serialized (ORJSONResponse), so the models only document the API.
+class UserSummary(BaseModel):
+    user_id: str
+    username: str
+    first_name: str
+    last_name: str
+
+class ChatUser(UserSummary):
+    is_online: bool = False
+
+class ChatSummary(BaseModel):
+    chat_id: str
+    is_group: bool = False
+    name: Optional[str] = None  # groups
+    other_user: Optional[ChatUser] = None  # direct chats
+    last_message: Optional[str] = None
+    last_message_time: Optional[datetime] = None
+    last_sender_id: Optional[str] = None
+    unread_count: int = 0
+    last_read_at: Optional[datetime] = None
+    created_at: datetime
+
+class Membership(BaseModel):
+    chat_id: str
+    user_ids: List[str]  # members actually added or removed by the request
+    member_count: int
+
+class ReadState(BaseModel):
+    chat_id: str
+    unread_count: int
+    last_read_at: datetime
+
+class MessageOut(BaseModel):
+    message_id: str
+    content: str
+    timestamp: datetime
+    sender: Optional[UserSummary] = None
+    is_own_message: bool
@@ -0,0 +1,166 @@
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from chat.sse import Frame, encode_event
+from config import PRESENCE_TIMEOUT_SECONDS, PRESENCE_FLUSH_INTERVAL_SECONDS
+
+# publish(recipients, frame), i.e. Broker.publish
+Publish = Callable[[List[str], Frame], Awaitable[None]]
+
+
+class PresenceService:
+    """
+    Online state of the users connected to this process, kept in memory.
+
+    A user is online while they have a live SSE/WebSocket connection, or for
+    PRESENCE_TIMEOUT_SECONDS after their last heartbeat (login). Changes are collected
+    and, every PRESENCE_FLUSH_INTERVAL_SECONDS, written to users.is_online / last_seen
+    in one bulk write and pushed as "presence" events to the user's chat partners.
+    A user who disconnects and reconnects within one interval causes no write at all.
+
+    Online users are stored again (is_online and last_seen) every half timeout, so readers
+    on other processes can ignore an is_online flag left behind by a process that died, and
+    a user connected to several workers is marked online again within half a timeout after
+    one of those workers stored them as offline.
+    """
+
+    def __init__(self, get_db, timeout: float = PRESENCE_TIMEOUT_SECONDS,
+                 flush_interval: float = PRESENCE_FLUSH_INTERVAL_SECONDS):
+        self.get_db = get_db
+        self.timeout = timeout
+        self.flush_interval = flush_interval
+        self._seen: Dict[str, float] = {}  # online user_id -> last heartbeat (monotonic)
+        self._stored_at: Dict[str, float] = {}  # user_id stored as online -> when last_seen was written
+        self._changed: Set[str] = set()
+        self._is_connected: Callable[[str], bool] = lambda user_id: False
+        self._publish: Optional[Publish] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.writes = 0
+        self.events = 0
+
+    def start(self, is_connected: Callable[[str], bool], publish: Publish):
+        self._is_connected = is_connected
+        self._publish = publish
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flush loop; users connected to this process are stored as offline."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._changed.update(self._seen)
+        self._seen.clear()
+        try:
+            await self.flush()
+        except PyMongoError as e:
+            logging.error(f"Failed to store presence on shutdown: {e}")
+
+    def heartbeat(self, user_id: str):
+        if user_id not in self._seen:
+            self._changed.add(user_id)
+        self._seen[user_id] = time.monotonic()
+
+    def offline(self, user_id: str):
+        if self._seen.pop(user_id, None) is not None:
+            self._changed.add(user_id)
+
+    def is_online(self, user: dict) -> bool:
+        """
+        Presence of a user document (needs user_id, is_online and last_seen): from memory
+        when this process knows the user, otherwise the stored flag if it is still fresh.
+        """
+        user_id = user.get("user_id")
+        if user_id in self._seen:
+            return True
+        if user_id in self._changed:
+            return False
+        last_seen = user.get("last_seen")
+        return bool(user.get("is_online")) and last_seen is not None and \
+            last_seen > datetime.now() - timedelta(seconds=self.timeout)
+
+    def _expire(self):
+        now = time.monotonic()
+        for user_id, seen in list(self._seen.items()):
+            if self._is_connected(user_id):
+                self._seen[user_id] = now
+            elif now - seen > self.timeout:
+                self.offline(user_id)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self._expire()
+            try:
+                await self.flush()
+            except PyMongoError as e:
+                logging.error(f"Failed to store presence: {e}")
+
+    async def flush(self):
+        now = time.monotonic()
+        changed = {
+            user_id: user_id in self._seen
+            for user_id in self._changed
+            if (user_id in self._stored_at) != (user_id in self._seen)
+        }
+        self._changed = set()
+        stale = [
+            user_id for user_id in self._seen
+            if user_id not in changed and now - self._stored_at.get(user_id, 0) > self.timeout / 2
+        ]
+        if not changed and not stale:
+            return
+
+        last_seen = datetime.now()
+        updates = [UpdateOne({"user_id": user_id}, {"$set": {"is_online": online, "last_seen": last_seen}})
+                   for user_id, online in changed.items()]
+        updates += [UpdateOne({"user_id": user_id}, {"$set": {"is_online": True, "last_seen": last_seen}})
+                    for user_id in stale]
+        db = await self.get_db()
+        try:
+            await db.users.bulk_write(updates, ordered=False)
+        except (PyMongoError, asyncio.CancelledError):
+            self._changed.update(changed)
+            raise
+        self.writes += len(updates)
+
+        for user_id, online in changed.items():
+            if online:
+                self._stored_at[user_id] = now
+            else:
+                self._stored_at.pop(user_id, None)
+        for user_id in stale:
+            self._stored_at[user_id] = now
+
+        if changed and self._publish is not None:
+            await self._announce(db, changed, last_seen)
+
+    async def _announce(self, db, changed: Dict[str, bool], last_seen: datetime):
+        """Push one presence event per changed user to everyone sharing a chat with them."""
+        partners: Dict[str, Set[str]] = {user_id: set() for user_id in changed}
+        async for chat in db.chats.find({"participants": {"$in": list(changed)}}, {"_id": 0, "participants": 1}):
+            for user_id in chat["participants"]:
+                if user_id in partners:
+                    partners[user_id].update(p for p in chat["participants"] if p != user_id)
+
+        for user_id, online in changed.items():
+            if partners[user_id]:
+                event = {"type": "presence", "user_id": user_id, "is_online": online, "last_seen": last_seen}
+                await self._publish(sorted(partners[user_id]), encode_event(event))
+                self.events += 1
+
+    def stats(self) -> dict:
+        return {
+            "online": len(self._seen),
+            "pending_changes": len(self._changed),
+            "writes": self.writes,
+            "events": self.events,
+        }
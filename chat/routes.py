@@ -1,8 +1,24 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+import orjson
+from pymongo import ReturnDocument, UpdateOne
 from database import get_db
 from auth.models import User
-from chat.models import Chat
+from chat.models import Chat, ChatSummary, ChatUser, GroupCreate, MemberChange, Membership, MessageOut, ReadState
+from chat.cache import (
+    forget_participants, get_participants, get_sender_summary, get_sender_summaries, remember_participants,
+)
+from chat.summaries import chat_list_version, new_summaries, mark_read
+from chat.store import Position, local_time, message_store
+from chat.sse import encode_event
+from config import GROUP_MAX_MEMBERS
+from conditional import cache_headers, make_etag, not_modified
+from projections import (
+    CHAT_PROJECTION, CHAT_SUMMARY_PROJECTION, MEMBER_PROJECTION, USER_PRESENCE_PROJECTION,
+)
+from chat.websocket import presence, manager
 from auth.utils import get_current_user
 from auth.customPydantic import UserOut
 
@@ -10,97 +26,384 @@ router = APIRouter(prefix="/api/chats", tags=["Chat"])
 
 # Chat endpoints
 @router.post("/create")
-async def create_chat(other_user_id: str, current_user: UserOut = Depends(get_current_user)):
-    db = await get_db()
+async def create_chat(other_user_id: str, current_user: UserOut = Depends(get_current_user), db=Depends(get_db)):
     # Check if chat already exists between these users
     existing_chat = await db.chats.find_one({
         "participants": {"$all": [current_user.user_id, other_user_id]}
-    })
+    }, CHAT_PROJECTION)
 
     if existing_chat:
+        remember_participants(existing_chat["chat_id"], existing_chat["participants"])
         return Chat(**existing_chat)
 
     # Create new chat
     chat = Chat(participants=[current_user.user_id, other_user_id])
+    chat.last_activity = chat.created_at
     await db.chats.insert_one(chat.model_dump())
+    await db.chat_summaries.insert_many(new_summaries(chat.model_dump()))
+    remember_participants(chat.chat_id, chat.participants)
     return chat
 
 
-@router.get("/", response_model=List[dict])
-async def get_user_chats(current_user: UserOut = Depends(get_current_user)):
-    db = await get_db()
-    # Fetch chats where current user is a participant
-    chats = await db.chats.find({
-        "participants": current_user.user_id
-    }).to_list(100)
+# Group chats. Members are stored as their chat_summaries documents (see chat.summaries),
+# not in the chat document, and the chat keeps a member_count.
+async def _require_users(db, user_ids: List[str]):
+    if not user_ids:
+        return
+    found = {user["user_id"] async for user in db.users.find({"user_id": {"$in": user_ids}}, MEMBER_PROJECTION)}
+    missing = [user_id for user_id in user_ids if user_id not in found]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Unknown users: {', '.join(missing[:10])}")
 
-    enhanced_chats = []
 
-    for chat in chats:
-        # Identify the other participant
-        other_user_id = next(p for p in chat["participants"] if p != current_user.user_id)
+async def _get_group(db, chat_id: str, user_id: str) -> Tuple[dict, List[str]]:
+    """The group chat document and its members; the user must be one of them."""
+    chat = await db.chats.find_one({"chat_id": chat_id}, CHAT_PROJECTION)
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    if not chat.get("is_group"):
+        raise HTTPException(status_code=400, detail="Not a group chat")
+    members = await get_participants(db, chat_id)
+    if user_id not in members:
+        raise HTTPException(status_code=403, detail="Access denied")
+    return chat, members
+
+
+def _announce_members(chat_id: str, recipients: List[str], by: str, added=(), removed=()):
+    """Tell members (and removed users) about a membership change; also drops cached member lists on every worker."""
+    event = {"type": "members", "chat_id": chat_id, "by": by, "added": list(added), "removed": list(removed)}
+    manager.fanout.submit(recipients, encode_event(event))
+
+
+@router.post("/groups", response_model=Chat)
+async def create_group(group: GroupCreate, current_user: UserOut = Depends(get_current_user), db=Depends(get_db)):
+    """Create a group chat with the current user and `member_ids` as its members."""
+    members = list(dict.fromkeys([current_user.user_id, *group.member_ids]))
+    if len(members) > GROUP_MAX_MEMBERS:
+        raise HTTPException(status_code=400, detail=f"A group has at most {GROUP_MAX_MEMBERS} members")
+    await _require_users(db, members[1:])
+
+    chat = Chat(is_group=True, name=group.name, created_by=current_user.user_id, member_count=len(members))
+    chat.last_activity = chat.created_at
+    await db.chats.insert_one(chat.model_dump())
+    await db.chat_summaries.insert_many(new_summaries(chat.model_dump(), members), ordered=False)
+    remember_participants(chat.chat_id, members)
+    _announce_members(chat.chat_id, members, current_user.user_id, added=members)
+    return chat
+
+
+@router.post("/{chat_id}/members", response_model=Membership)
+async def add_members(
+    chat_id: str,
+    change: MemberChange,
+    current_user: UserOut = Depends(get_current_user),
+    db=Depends(get_db),
+):
+    """Add users to a group chat; any member can. Users already in the group are skipped."""
+    chat, members = await _get_group(db, chat_id, current_user.user_id)
+    current = set(members)
+    user_ids = [user_id for user_id in dict.fromkeys(change.user_ids) if user_id not in current]
+    if chat.get("member_count", len(members)) + len(user_ids) > GROUP_MAX_MEMBERS:
+        raise HTTPException(status_code=400, detail=f"A group has at most {GROUP_MAX_MEMBERS} members")
+    await _require_users(db, user_ids)
+
+    added = []
+    if user_ids:
+        # Upserts, so a user added by a concurrent request is neither duplicated nor counted twice
+        summaries = new_summaries(chat, user_ids, joined_at=datetime.now())
+        result = await db.chat_summaries.bulk_write([
+            UpdateOne({"chat_id": chat_id, "user_id": summary["user_id"]}, {"$setOnInsert": summary}, upsert=True)
+            for summary in summaries
+        ], ordered=False)
+        added = [summaries[index]["user_id"] for index in sorted(result.upserted_ids)]
+    if added:
+        chat = await db.chats.find_one_and_update(
+            {"chat_id": chat_id}, {"$inc": {"member_count": len(added)}},
+            {"_id": 0, "member_count": 1}, return_document=ReturnDocument.AFTER,
+        )
+        forget_participants(chat_id)
+        _announce_members(chat_id, members + added, current_user.user_id, added=added)
+    return ORJSONResponse({"chat_id": chat_id, "user_ids": added, "member_count": chat["member_count"]})
+
+
+@router.delete("/{chat_id}/members/{user_id}", response_model=Membership)
+async def remove_member(
+    chat_id: str,
+    user_id: str,
+    current_user: UserOut = Depends(get_current_user),
+    db=Depends(get_db),
+):
+    """Remove a member from a group chat: the creator can remove anyone, other members only themselves."""
+    chat, members = await _get_group(db, chat_id, current_user.user_id)
+    if user_id != current_user.user_id and chat.get("created_by") != current_user.user_id:
+        raise HTTPException(status_code=403, detail="Only the group creator can remove other members")
+
+    result = await db.chat_summaries.delete_one({"chat_id": chat_id, "user_id": user_id})
+    removed = [user_id] if result.deleted_count else []
+    if removed:
+        chat = await db.chats.find_one_and_update(
+            {"chat_id": chat_id}, {"$inc": {"member_count": -1}},
+            {"_id": 0, "member_count": 1}, return_document=ReturnDocument.AFTER,
+        )
+        forget_participants(chat_id)
+        # Sent to the members before the change, so the removed user hears about it too
+        _announce_members(chat_id, members, current_user.user_id, removed=removed)
+    return ORJSONResponse({"chat_id": chat_id, "user_ids": removed, "member_count": chat["member_count"]})
+
+
+def _chat_user(user: dict) -> dict:
+    return {
+        "user_id": user["user_id"],
+        "username": user["username"],
+        "first_name": user["first_name"],
+        "last_name": user["last_name"],
+        "is_online": presence.is_online(user),
+    }
+
+
+@router.get("/{chat_id}/members", response_model=List[ChatUser])
+async def get_chat_members(
+    chat_id: str,
+    limit: int = Query(100, ge=1, le=1000),
+    after: Optional[str] = None,
+    current_user: UserOut = Depends(get_current_user),
+    db=Depends(get_db),
+):
+    """
+    Members of a chat ordered by user_id. Pass the X-Next-Cursor response header back
+    as `after` to fetch the next page.
+    """
+    participants = await get_participants(db, chat_id)
+    if not participants or current_user.user_id not in participants:
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    match = {"chat_id": chat_id}
+    if after:
+        match["user_id"] = {"$gt": after}
+    page = await db.chat_summaries.find(match, MEMBER_PROJECTION).sort("user_id", 1).limit(limit).to_list(limit)
+    headers = {}
+    if len(page) == limit:
+        headers["X-Next-Cursor"] = page[-1]["user_id"]
+
+    users = {
+        user["user_id"]: user
+        async for user in db.users.find({"user_id": {"$in": [m["user_id"] for m in page]}}, USER_PRESENCE_PROJECTION)
+    }
+    return ORJSONResponse([_chat_user(users[m["user_id"]]) for m in page if m["user_id"] in users], headers=headers)
+
 
-        # Fetch other user document
-        other_user_doc = await db.users.find_one({"user_id": other_user_id})
-        if not other_user_doc:
-            continue  # skip if user not found
+def _parse_time(value: str) -> datetime:
+    """
+    ISO timestamp from a client as naive local time, like the stored Message.timestamp;
+    an offset (or Z) is converted. Raises ValueError if it is not a timestamp.
+    """
+    return local_time(datetime.fromisoformat(value.replace("Z", "+00:00") if value.endswith("Z") else value))
 
-        # Ensure _id exists for Pydantic model
-        other_user_doc.setdefault("_id", None)
-        other_user_doc.setdefault("is_online", False)
 
-        other_user = UserOut(**other_user_doc)
+def _encode_cursor(timestamp: datetime, key: str) -> str:
+    """Opaque keyset cursor: sort timestamp plus a unique id as tie-breaker."""
+    return f"{timestamp.isoformat()}|{key}"
 
-        # Build enhanced chat object
-        enhanced_chats.append({
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        timestamp, key = cursor.split("|", 1)
+        return _parse_time(timestamp), key
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@router.get("/", response_model=List[ChatSummary])
+async def get_user_chats(
+    request: Request,
+    limit: int = Query(100, ge=1, le=100),
+    before: Optional[str] = None,
+    current_user: UserOut = Depends(get_current_user),
+    db=Depends(get_db),
+):
+    """
+    Chats of the current user, most recent activity first.
+    Pass the X-Next-Cursor response header back as `before` to fetch the next page.
+    The ETag changes with any of the user's chat summaries (previews, unread counts,
+    joined or left chats); send it as If-None-Match to get 304 when nothing changed.
+    Presence of the other users is not part of it; it is pushed as events instead.
+    """
+    etag = make_etag("chats", *await chat_list_version(db, current_user.user_id))
+    unchanged = not_modified(request, etag)
+    if unchanged:
+        return unchanged
+
+    match = {"user_id": current_user.user_id}
+    if before:
+        before_time, before_chat_id = _decode_cursor(before)
+        match["$or"] = [
+            {"last_activity": {"$lt": before_time}},
+            {"last_activity": before_time, "chat_id": {"$lt": before_chat_id}},
+        ]
+
+    # Previews and unread counts come from the user's chat summaries, sorted and paged by
+    # the (user_id, last_activity, chat_id) index; then the other participants of direct
+    # chats in one projected round trip
+    chats = await db.chat_summaries.find(match, CHAT_SUMMARY_PROJECTION).sort(
+        [("last_activity", -1), ("chat_id", -1)]
+    ).limit(limit).to_list(limit)
+    headers = cache_headers(etag)
+    if len(chats) == limit:
+        headers["X-Next-Cursor"] = _encode_cursor(chats[-1]["last_activity"], chats[-1]["chat_id"])
+
+    members = {
+        user["user_id"]: user
+        async for user in db.users.find(
+            {"user_id": {"$in": [chat["other_user_id"] for chat in chats if chat.get("other_user_id")]}},
+            USER_PRESENCE_PROJECTION,
+        )
+    }
+
+    # Skip direct chats whose other participant no longer exists
+    summaries = []
+    for chat in chats:
+        other_user = members.get(chat.get("other_user_id"))
+        if other_user is None and not chat.get("is_group"):
+            continue
+        summaries.append({
             "chat_id": chat["chat_id"],
-            "other_user": {
-                "user_id": other_user.user_id,
-                "username": other_user.username,
-                "first_name": other_user.first_name,
-                "last_name": other_user.last_name,
-                "is_online": other_user.is_online
-            },
+            "is_group": chat.get("is_group", False),
+            "name": chat.get("name"),
+            "other_user": _chat_user(other_user) if other_user else None,
             "last_message": chat.get("last_message"),
             "last_message_time": chat.get("last_message_time"),
-            "created_at": chat["created_at"]
+            "last_sender_id": chat.get("last_sender_id"),
+            "unread_count": chat.get("unread_count", 0),
+            "last_read_at": chat.get("last_read_at"),
+            "created_at": chat["created_at"],
         })
+    return ORJSONResponse(summaries, headers=headers)
+
+
+@router.post("/{chat_id}/read", response_model=ReadState)
+async def mark_chat_read(
+    chat_id: str,
+    until: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    db=Depends(get_db),
+):
+    """
+    Mark the chat read up to `until` (a message_id or ISO timestamp; default: everything).
+    The user's other sessions get a "read" event, and so do the other participants
+    of a direct chat (not of groups, where every read would reach every member).
+    """
+    participants = await get_participants(db, chat_id)
+    if not participants or current_user.user_id not in participants:
+        raise HTTPException(status_code=403, detail="Access denied")
 
-    # Sort chats by last message time (or created_at if no messages)
-    enhanced_chats.sort(
-        key=lambda x: x.get("last_message_time") or x["created_at"],
-        reverse=True
-    )
+    read_at = None
+    if until:
+        try:
+            read_at = _parse_time(until)
+        except ValueError:
+            message = await message_store.find(db, chat_id, until)
+            if not message:
+                raise HTTPException(status_code=400, detail="Unknown message")
+            read_at = message["timestamp"]
 
-    return enhanced_chats
+    state = await mark_read(db, current_user.user_id, chat_id, read_at)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Chat summary not found")
+    is_group = state.pop("is_group")
+    if state.pop("advanced"):
+        event = {"type": "read", "chat_id": chat_id, "user_id": current_user.user_id, "last_read_at": state["last_read_at"]}
+        manager.fanout.submit([current_user.user_id] if is_group else participants, encode_event(event))
+    return ORJSONResponse(state)
 
 
-@router.get("/{chat_id}/messages", response_model=List[dict])
-async def get_chat_messages(chat_id: str, current_user: User = Depends(get_current_user)):
-    db = await get_db()
+async def _message_position(db, chat_id: str, value: str) -> Position:
+    """
+    Keyset position for paging strictly before or after it: a cursor from a previous
+    page, a message_id or an ISO timestamp.
+    """
+    if "|" in value:
+        return _decode_cursor(value)
+    try:
+        return _parse_time(value), None
+    except ValueError:
+        pass
+    anchor = await message_store.find(db, chat_id, value)
+    if not anchor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return anchor["timestamp"], anchor["message_id"]
+
+
+def _message_out(message: dict, sender: Optional[dict], current_user_id: str) -> dict:
+    return {
+        "message_id": message["message_id"],
+        "content": message["content"],
+        "timestamp": message["timestamp"],
+        "sender": sender,  # already just the USER_SUMMARY_PROJECTION fields
+        "is_own_message": message["sender_id"] == current_user_id
+    }
+
+
+@router.get("/{chat_id}/messages", response_model=List[MessageOut])
+async def get_chat_messages(
+    request: Request,
+    chat_id: str,
+    limit: int = Query(1000, ge=1, le=1000),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    stream: bool = False,
+    current_user: User = Depends(get_current_user),
+    db=Depends(get_db),
+):
+    """
+    A page of chat history in ascending time order, newest page first.
+    `before`/`after` take a cursor (X-Before-Cursor / X-After-Cursor headers), a message_id
+    or an ISO timestamp. With `stream=true` messages are written as NDJSON as they are
+    read from the store, in read order (newest first unless `after` is given).
+    The ETag follows the chat's last_message_time: with a matching If-None-Match the
+    answer is 304 without reading messages.
+    """
     # Verify user is participant in chat
-    chat = await db.chats.find_one({"chat_id": chat_id})
-    if not chat or current_user.user_id not in chat["participants"]:
+    participants = await get_participants(db, chat_id)
+    if not participants or current_user.user_id not in participants:
         raise HTTPException(status_code=403, detail="Access denied")
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+
+    chat = await db.chats.find_one({"chat_id": chat_id}, {"_id": 0, "last_message_time": 1}) or {}
+    last_message_time = chat.get("last_message_time")
+    etag = make_etag("messages", int(last_message_time.timestamp() * 1000) if last_message_time else 0)
+    unchanged = not_modified(request, etag)
+    if unchanged:
+        return unchanged
+
+    # Keyset pagination in the configured message store (chat/store.py)
+    before_position = await _message_position(db, chat_id, before) if before else None
+    after_position = await _message_position(db, chat_id, after) if after else None
+
+    if stream:
+        # Resolved as senders appear: a group may have thousands of members who never wrote
+        senders: Dict[str, Optional[dict]] = {}
+
+        async def ndjson_generator():
+            async for message in message_store.read(db, chat_id, before_position, after_position, limit):
+                if message["sender_id"] not in senders:
+                    senders[message["sender_id"]] = await get_sender_summary(db, message["sender_id"])
+                item = _message_out(message, senders.get(message["sender_id"]), current_user.user_id)
+                yield orjson.dumps(item) + b"\n"
+
+        return StreamingResponse(ndjson_generator(), media_type="application/x-ndjson", headers=cache_headers(etag))
+
+    messages = await message_store.page(db, chat_id, before_position, after_position, limit)
+    if not after:
+        messages.reverse()
+
+    headers = cache_headers(etag)
+    if messages:
+        headers["X-Before-Cursor"] = _encode_cursor(messages[0]["timestamp"], messages[0]["message_id"])
+        headers["X-After-Cursor"] = _encode_cursor(messages[-1]["timestamp"], messages[-1]["message_id"])
 
-    messages = await db.messages.find({"chat_id": chat_id}).sort("timestamp", 1).to_list(1000)
-
-    # Enhance messages with sender info
-    enhanced_messages = []
-    for message in messages:
-        sender = await db.users.find_one({"user_id": message["sender_id"]})
-        enhanced_message = {
-            "message_id": message["message_id"],
-            "content": message["content"],
-            "timestamp": message["timestamp"],
-            "sender": {
-                "user_id": sender["user_id"],
-                "username": sender["username"],
-                "first_name": sender["first_name"],
-                "last_name": sender["last_name"]
-            },
-            "is_own_message": message["sender_id"] == current_user.user_id
-        }
-        enhanced_messages.append(enhanced_message)
-
-    return enhanced_messages
+    senders = await get_sender_summaries(db, (message["sender_id"] for message in messages))
+    return ORJSONResponse([
+        _message_out(message, senders.get(message["sender_id"]), current_user.user_id)
+        for message in messages
+    ], headers=headers)
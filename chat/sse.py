@@ -0,0 +1,103 @@
+import time
+from collections import deque
+from datetime import datetime
+from typing import List, NamedTuple, Optional
+import orjson
+from bson import ObjectId
+
+
+class Frame(NamedTuple):
+    """
+    An event encoded once and shared, unchanged, by every recipient queue:
+    `data` is the SSE frame and `json` the bare payload sent over WebSockets.
+    """
+    data: bytes
+    json: bytes
+    chat_id: Optional[str] = None
+    event_id: Optional[int] = None
+    event_type: Optional[str] = None
+
+
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def encode_event(event: dict, event_id: Optional[int] = None) -> Frame:
+    """
+    Encode an event as a `data:` frame; datetimes are written natively in ISO format.
+    Events with an id can be resumed with Last-Event-ID.
+    """
+    return build_frame(orjson.dumps(event, default=_default), event.get("chat_id"), event_id, event.get("type"))
+
+
+def build_frame(payload: bytes, chat_id: Optional[str] = None, event_id: Optional[int] = None,
+                event_type: Optional[str] = None) -> Frame:
+    data = b"data: " + payload + b"\n\n"
+    if event_id is not None:
+        data = b"id: %d\n" % event_id + data
+    return Frame(data, payload, chat_id, event_id, event_type)
+
+
+KEEPALIVE = b": keepalive\n\n"
+
+
+# Event ids are the message time in milliseconds * EVENT_ID_MS, plus a per-process counter
+# * EVENT_ID_SLOTS, plus the worker slot of this process. They increase monotonically, two
+# workers never hand out the same id (CHAT_BROKER=mongo gives every worker its own slot, see
+# chat.broker.MongoCappedBroker) and they can be turned back into a timestamp for history queries
+EVENT_ID_MS = 1_000_000
+EVENT_ID_SLOTS = 1000
+_worker_slot = 0
+_last_event_id = 0
+
+
+def set_worker_slot(slot: int):
+    global _worker_slot
+    _worker_slot = slot % EVENT_ID_SLOTS
+
+
+def next_event_id(timestamp: datetime) -> int:
+    global _last_event_id
+    counter = max(event_id_floor(timestamp), _last_event_id - _worker_slot + EVENT_ID_SLOTS)
+    _last_event_id = counter + _worker_slot
+    return _last_event_id
+
+
+def event_id_floor(timestamp: datetime) -> int:
+    """Lowest id an event of the millisecond of `timestamp` can have."""
+    return int(timestamp.timestamp() * 1000) * EVENT_ID_MS
+
+
+def event_id_time(event_id: int) -> datetime:
+    """Local time (like Message.timestamp) of the millisecond an event id belongs to."""
+    return datetime.fromtimestamp(event_id // EVENT_ID_MS / 1000)
+
+
+def current_event_id() -> int:
+    """Lowest id an event created from now on can have."""
+    return int(time.time() * 1000) * EVENT_ID_MS
+
+
+class ReplayRing:
+    """
+    Bounded buffer of the latest frames sent to one user. Every event with an id
+    greater than `since_id` is still in the ring, so a reconnect after such an id
+    can be served from memory.
+    """
+
+    def __init__(self, size: int):
+        self.frames: deque = deque(maxlen=size)
+        self.since_id = current_event_id()
+
+    def append(self, frame: Frame):
+        if len(self.frames) == self.frames.maxlen:
+            self.since_id = self.frames[0].event_id
+        self.frames.append(frame)
+
+    def covers(self, last_event_id: int) -> bool:
+        return last_event_id >= self.since_id
+
+    def after(self, last_event_id: int) -> List[Frame]:
+        return [frame for frame in self.frames if frame.event_id > last_event_id]
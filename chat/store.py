@@ -0,0 +1,360 @@
+"""
+Message storage engines behind the history read and write paths (MESSAGE_STORAGE).
+
+documents: one `messages` document per message, paged by the (chat_id, timestamp,
+           message_id) index.
+buckets:   `message_buckets` documents, each packing a chat's messages of one
+           MESSAGE_BUCKET_SECONDS window (a busy window is split into parts of about
+           MESSAGE_BUCKET_MAX_MESSAGES). Messages are stored without the chat_id and
+           message_type they share, and the history index has one entry per bucket
+           instead of one per message. Windows older than MESSAGE_COMPACT_AFTER_SECONDS
+           are compacted into a single zlib-compressed BSON block. A page of history
+           reads one or two bucket documents. Each bucket also lists its message_ids
+           (uncompressed, on the chat_id_message_ids index), so `find` reads only the
+           bucket holding the message.
+
+Positions are (timestamp, message_id) keyset pairs; a position without message_id
+(an ISO timestamp from the client) compares by timestamp alone. Timestamps are naive
+local time, like Message.timestamp; see `local_time`.
+"""
+import zlib
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import bson
+from bson.binary import Binary
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from database import get_db
+from projections import MESSAGE_PROJECTION
+from config import (
+    MESSAGE_STORAGE, MESSAGE_BUCKET_SECONDS, MESSAGE_BUCKET_MAX_MESSAGES,
+    MESSAGE_COMPACT_AFTER_SECONDS, MESSAGE_COMPACT_INTERVAL_SECONDS,
+)
+
+DUPLICATE_KEY = 11000
+EPOCH = datetime(1970, 1, 1)
+
+Position = Tuple[datetime, Optional[str]]
+
+# Bucket fields the readers unpack
+BUCKET_PROJECTION = {"_id": 0, "count": 0, "message_ids": 0}
+
+
+def local_time(timestamp: datetime) -> datetime:
+    """`timestamp` as naive local time; a zoned datetime is converted."""
+    if timestamp.tzinfo is not None:
+        return timestamp.astimezone().replace(tzinfo=None)
+    return timestamp
+
+
+def _position(position: Optional[Position]) -> Optional[Position]:
+    return (local_time(position[0]), position[1]) if position else None
+
+
+def _key(message: dict) -> Tuple[datetime, str]:
+    return message["timestamp"], message["message_id"]
+
+
+def _is_before(message: dict, position: Position) -> bool:
+    timestamp, message_id = position
+    return message["timestamp"] < timestamp if message_id is None else _key(message) < position
+
+
+def _is_after(message: dict, position: Position) -> bool:
+    timestamp, message_id = position
+    return message["timestamp"] > timestamp if message_id is None else _key(message) > position
+
+
+class MessageStore:
+    """
+    `read` yields at least message_id, sender_id, content and timestamp; `find` and
+    `since` return whole messages (the fields of chat.models.Message).
+    """
+    name = "base"
+
+    async def insert(self, db, messages: List[dict]):
+        """Store messages; storing the same message_id twice must be harmless (batch retries)."""
+        raise NotImplementedError
+
+    async def find(self, db, chat_id: str, message_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def read(self, db, chat_id: str, before: Optional[Position] = None, after: Optional[Position] = None,
+             limit: int = 100) -> AsyncIterator[dict]:
+        """Up to `limit` messages before/after a position, newest first unless `after` is given."""
+        raise NotImplementedError
+
+    async def page(self, db, chat_id: str, before: Optional[Position] = None, after: Optional[Position] = None,
+                   limit: int = 100) -> List[dict]:
+        return [message async for message in self.read(db, chat_id, before, after, limit)]
+
+    async def count_after(self, db, chat_id: str, timestamp: datetime, exclude_sender_id: str) -> int:
+        """Messages newer than `timestamp` not sent by `exclude_sender_id` (unread counters)."""
+        raise NotImplementedError
+
+    async def since(self, db, chat_ids: List[str], timestamp: datetime, limit: int) -> List[dict]:
+        """Up to `limit` messages of the chats at or after `timestamp`, oldest first (SSE replay)."""
+        raise NotImplementedError
+
+
+class DocumentStore(MessageStore):
+    name = "documents"
+
+    async def insert(self, db, messages: List[dict]):
+        try:
+            await db.messages.insert_many(messages, ordered=False)
+        except BulkWriteError as e:
+            # Messages already stored by an earlier, partially failed attempt
+            if any(error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]):
+                raise
+
+    async def find(self, db, chat_id: str, message_id: str) -> Optional[dict]:
+        return await db.messages.find_one({"chat_id": chat_id, "message_id": message_id}, {"_id": 0})
+
+    @staticmethod
+    def _keyset(position: Position, op: str) -> dict:
+        timestamp, message_id = position
+        if message_id is None:
+            return {"timestamp": {op: timestamp}}
+        return {"$or": [
+            {"timestamp": {op: timestamp}},
+            {"timestamp": timestamp, "message_id": {op: message_id}},
+        ]}
+
+    async def read(self, db, chat_id: str, before: Optional[Position] = None, after: Optional[Position] = None,
+                   limit: int = 100) -> AsyncIterator[dict]:
+        query = {"chat_id": chat_id}
+        if before:
+            query.update(self._keyset(before, "$lt"))
+        if after:
+            query.update(self._keyset(after, "$gt"))
+        direction = 1 if after else -1
+        cursor = db.messages.find(query, MESSAGE_PROJECTION).sort(
+            [("timestamp", direction), ("message_id", direction)]
+        ).limit(limit).batch_size(min(limit, 100))
+        async for message in cursor:
+            yield message
+
+    async def count_after(self, db, chat_id: str, timestamp: datetime, exclude_sender_id: str) -> int:
+        return await db.messages.count_documents(
+            {"chat_id": chat_id, "timestamp": {"$gt": timestamp}, "sender_id": {"$ne": exclude_sender_id}}
+        )
+
+    async def since(self, db, chat_ids: List[str], timestamp: datetime, limit: int) -> List[dict]:
+        return await db.messages.find(
+            {"chat_id": {"$in": chat_ids}, "timestamp": {"$gte": timestamp}}, {"_id": 0}
+        ).sort("timestamp", 1).limit(limit).to_list(limit)
+
+
+class BucketStore(MessageStore):
+    name = "buckets"
+
+    def __init__(self, bucket_seconds: int = MESSAGE_BUCKET_SECONDS, max_messages: int = MESSAGE_BUCKET_MAX_MESSAGES,
+                 compact_after: int = MESSAGE_COMPACT_AFTER_SECONDS):
+        self.bucket_seconds = bucket_seconds
+        self.max_messages = max_messages
+        self.compact_after = compact_after
+
+    def window(self, timestamp: datetime) -> datetime:
+        """Start of the bucket window holding `timestamp`."""
+        seconds = int((local_time(timestamp) - EPOCH).total_seconds())
+        return EPOCH + timedelta(seconds=seconds - seconds % self.bucket_seconds)
+
+    @staticmethod
+    def _pack(message: dict) -> dict:
+        packed = {
+            "message_id": message["message_id"],
+            "sender_id": message["sender_id"],
+            "content": message["content"],
+            "timestamp": message["timestamp"],
+        }
+        if message.get("message_type", "text") != "text":
+            packed["message_type"] = message["message_type"]
+        return packed
+
+    @staticmethod
+    def _unpack(bucket: dict) -> List[dict]:
+        if "block" in bucket:
+            messages = bson.decode(zlib.decompress(bucket["block"]))["messages"]
+        else:
+            messages = bucket.get("messages", [])
+        for message in messages:
+            message["chat_id"] = bucket["chat_id"]
+            message.setdefault("message_type", "text")
+        return messages
+
+    async def insert(self, db, messages: List[dict]):
+        groups: Dict[Tuple[str, datetime], List[dict]] = {}
+        for message in messages:
+            groups.setdefault((message["chat_id"], self.window(message["timestamp"])), []).append(self._pack(message))
+
+        # Appended to an open (uncompacted, not full) part of the window, or a new part is
+        # upserted. Two writers may both start a part; readers merge all parts of a window.
+        updates = []
+        for (chat_id, window), packed in groups.items():
+            for i in range(0, len(packed), self.max_messages):
+                chunk = packed[i:i + self.max_messages]
+                updates.append(UpdateOne(
+                    {"chat_id": chat_id, "window": window, "count": {"$lt": self.max_messages},
+                     "block": {"$exists": False}},
+                    {"$push": {"messages": {"$each": chunk},
+                               "message_ids": {"$each": [m["message_id"] for m in chunk]}},
+                     "$inc": {"count": len(chunk)}},
+                    upsert=True,
+                ))
+        if updates:
+            await db.message_buckets.bulk_write(updates, ordered=False)
+
+    async def _windows(self, db, query: dict, descending: bool) -> AsyncIterator[List[dict]]:
+        """The messages of each window matching `query`, in order, deduplicated by message_id."""
+        sort = [("window", -1 if descending else 1)]
+        if not isinstance(query["chat_id"], str):
+            sort.append(("chat_id", 1))  # keep the parts of each (chat, window) together
+        cursor = db.message_buckets.find(query, BUCKET_PROJECTION).sort(sort)
+        current, parts = None, []
+        async for bucket in cursor:
+            if parts and (bucket["chat_id"], bucket["window"]) != current:
+                yield self._merge(parts, descending)
+                parts = []
+            current = (bucket["chat_id"], bucket["window"])
+            parts.append(bucket)
+        if parts:
+            yield self._merge(parts, descending)
+
+    def _merge(self, buckets: List[dict], descending: bool) -> List[dict]:
+        messages = {}
+        for bucket in buckets:
+            for message in self._unpack(bucket):
+                messages[message["message_id"]] = message
+        return sorted(messages.values(), key=_key, reverse=descending)
+
+    async def find(self, db, chat_id: str, message_id: str) -> Optional[dict]:
+        # The part holding the message; a batch retry may have stored it in two parts
+        bucket = await db.message_buckets.find_one({"chat_id": chat_id, "message_ids": message_id}, BUCKET_PROJECTION)
+        if bucket is None:
+            return None
+        return next((m for m in self._unpack(bucket) if m["message_id"] == message_id), None)
+
+    async def read(self, db, chat_id: str, before: Optional[Position] = None, after: Optional[Position] = None,
+                   limit: int = 100) -> AsyncIterator[dict]:
+        before, after = _position(before), _position(after)
+        query = {"chat_id": chat_id}
+        if before:
+            query["window"] = {"$lte": self.window(before[0])}
+        if after:
+            query["window"] = {"$gte": self.window(after[0])}
+        remaining = limit
+        async for messages in self._windows(db, query, descending=after is None):
+            for message in messages:
+                if (before and not _is_before(message, before)) or (after and not _is_after(message, after)):
+                    continue
+                yield message
+                remaining -= 1
+                if not remaining:
+                    return
+
+    async def count_after(self, db, chat_id: str, timestamp: datetime, exclude_sender_id: str) -> int:
+        count = 0
+        timestamp = local_time(timestamp)
+        query = {"chat_id": chat_id, "window": {"$gte": self.window(timestamp)}}
+        async for messages in self._windows(db, query, descending=False):
+            count += sum(1 for m in messages if m["timestamp"] > timestamp and m["sender_id"] != exclude_sender_id)
+        return count
+
+    async def since(self, db, chat_ids: List[str], timestamp: datetime, limit: int) -> List[dict]:
+        messages = []
+        timestamp = local_time(timestamp)
+        query = {"chat_id": {"$in": chat_ids}, "window": {"$gte": self.window(timestamp)}}
+        last_window = None
+        async for window in self._windows(db, query, descending=False):
+            # Windows come in ascending order, one chat at a time within a window: once a
+            # window is complete and `limit` messages are collected, later ones cannot place
+            if not window:
+                continue
+            start = self.window(window[0]["timestamp"])
+            if start != last_window and len(messages) >= limit:
+                break
+            last_window = start
+            messages.extend(m for m in window if m["timestamp"] >= timestamp)
+        messages.sort(key=_key)
+        return messages[:limit]
+
+    async def compact(self, db, older_than: Optional[datetime] = None) -> int:
+        """
+        Rewrite every window that ended before `older_than` (default: compact_after ago) and
+        still has uncompressed parts as one compressed block. Returns the windows compacted.
+        A part that received messages meanwhile is kept; readers merge it with the block.
+        """
+        older_than = older_than or datetime.now() - timedelta(seconds=self.compact_after)
+        cutoff = self.window(older_than)
+        windows = set()
+        async for bucket in db.message_buckets.find(
+            {"window": {"$lt": cutoff}, "block": {"$exists": False}}, {"_id": 0, "chat_id": 1, "window": 1}
+        ):
+            windows.add((bucket["chat_id"], bucket["window"]))
+
+        for chat_id, window in sorted(windows):
+            parts = await db.message_buckets.find({"chat_id": chat_id, "window": window}).to_list(None)
+            messages = [self._pack(m) for m in self._merge(parts, descending=False)]
+            block = zlib.compress(bson.encode({"messages": messages}), 6)
+            await db.message_buckets.insert_one({
+                "chat_id": chat_id, "window": window, "count": len(messages), "block": Binary(block),
+                "message_ids": [m["message_id"] for m in messages],
+            })
+            for part in parts:
+                if "block" in part:
+                    await db.message_buckets.delete_one({"_id": part["_id"]})
+                else:
+                    await db.message_buckets.delete_one(
+                        {"_id": part["_id"], "count": part["count"], "block": {"$exists": False}}
+                    )
+        return len(windows)
+
+
+class BucketCompactor:
+    """
+    Compacts old bucket windows every `interval` seconds. Run it on one worker only
+    (MESSAGE_COMPACT_INTERVAL_SECONDS=0 disables it), or compact from cron with
+    `python migrate_messages.py --compact`.
+    """
+
+    def __init__(self, store: MessageStore, get_db, interval: float = MESSAGE_COMPACT_INTERVAL_SECONDS):
+        self.store = store
+        self.get_db = get_db
+        self.interval = interval
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self):
+        if isinstance(self.store, BucketStore) and self.interval > 0 and self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                compacted = await self.store.compact(await self.get_db())
+                if compacted:
+                    logging.info(f"Compacted {compacted} message bucket windows")
+            except PyMongoError as e:
+                logging.error(f"Failed to compact message buckets: {e}")
+
+
+def create_message_store() -> MessageStore:
+    if MESSAGE_STORAGE == "buckets":
+        return BucketStore()
+    return DocumentStore()
+
+
+message_store = create_message_store()
+message_compactor = BucketCompactor(message_store, get_db)
@@ -0,0 +1,132 @@
+"""
+Per-(user, chat) read model behind the chat list: preview of the newest message,
+unread counter and read position, one `chat_summaries` document per participant.
+
+For group chats the summaries are also the member list: a member is a user with a
+summary for the chat, so the chat document does not grow with the group.
+
+Sends update it with plain atomic operators, so concurrent sends need no locking:
+the preview $set only matches summaries whose last_message_time is older than the
+message, and unread counters are $inc'ed, with one update_many per message whatever
+the group size, for every member but the sender whose last_read_at is older than the
+message (so increments written after a mark-read, e.g. by batched writes, do not
+count messages already read).
+Mark-read recounts from the message store and stores the result with a
+compare-and-set on unread_count, retrying if a send landed in between.
+
+Every write also increments the summary's `version`, so the number of summaries and
+the sum of their versions identify the state of a user's chat list (its ETag).
+"""
+from datetime import datetime
+from typing import List, Optional, Tuple
+from fastapi import HTTPException
+from pymongo import UpdateMany
+from chat.store import message_store
+
+MARK_READ_ATTEMPTS = 5
+
+
+def _other(participants: List[str], user_id: str) -> Optional[str]:
+    return next((p for p in participants if p != user_id), None)
+
+
+def new_summaries(chat: dict, members: Optional[List[str]] = None,
+                  joined_at: Optional[datetime] = None) -> List[dict]:
+    """
+    Summaries of a chat, one per member (default: the participants of a direct chat);
+    counters start at zero. Members joining a group later pass `joined_at`, so the
+    history before it does not count as unread.
+    """
+    is_group = chat.get("is_group", False)
+    members = chat["participants"] if members is None else members
+    return [{
+        "user_id": user_id,
+        "chat_id": chat["chat_id"],
+        "other_user_id": None if is_group else _other(chat["participants"], user_id),
+        "is_group": is_group,
+        "name": chat.get("name"),
+        "unread_count": 0,
+        "last_read_at": stored_time(joined_at) if joined_at else None,
+        "last_message": chat.get("last_message"),
+        "last_message_time": chat.get("last_message_time"),
+        "last_sender_id": chat.get("last_sender_id"),
+        "created_at": chat["created_at"],
+        "last_activity": chat.get("last_activity") or chat["created_at"],
+        "version": 1,
+    } for user_id in dict.fromkeys(members)]
+
+
+def stored_time(timestamp: datetime) -> datetime:
+    """A datetime as MongoDB stores it (millisecond precision), for comparisons with stored ones."""
+    return timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+
+
+def summary_updates(chat_id: str, preview: dict, sent: List[Tuple[str, datetime]]) -> list:
+    """
+    Bulk operations for new messages in a chat: `preview` is the chat update of the
+    newest one (see chat.writer), `sent` the (sender_id, timestamp) of each message.
+    A message only counts as unread for members who have not read past it.
+    """
+    newer = {"chat_id": chat_id, "$or": [
+        {"last_message_time": None},
+        {"last_message_time": {"$lt": preview["last_message_time"]}},
+    ]}
+    updates = [UpdateMany(newer, {"$set": preview, "$inc": {"version": 1}})]
+    for sender_id, timestamp in sent:
+        unread_after = {"$or": [{"last_read_at": None}, {"last_read_at": {"$lt": stored_time(timestamp)}}]}
+        updates.append(UpdateMany(
+            {"chat_id": chat_id, "user_id": {"$ne": sender_id}, **unread_after},
+            {"$inc": {"unread_count": 1, "version": 1}},
+        ))
+    return updates
+
+
+async def chat_list_version(db, user_id: str) -> Tuple[int, int]:
+    """(number of chats, sum of summary versions) of the user, read from the user_id_version index."""
+    result = await db.chat_summaries.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$project": {"_id": 0, "version": 1}},
+        {"$group": {"_id": None, "chats": {"$sum": 1}, "version": {"$sum": "$version"}}},
+    ]).to_list(1)
+    return (result[0]["chats"], result[0]["version"]) if result else (0, 0)
+
+
+async def mark_read(db, user_id: str, chat_id: str, read_at: Optional[datetime] = None) -> Optional[dict]:
+    """
+    Mark the chat read up to `read_at` (default: now; a later time is clamped to now, since
+    a read position in the future would hide every message sent until then). Returns the
+    updated summary fields plus whether the position advanced and the chat is a group, or
+    None if the user has no summary for the chat. The read position only moves forward.
+    """
+    for _ in range(MARK_READ_ATTEMPTS):
+        summary = await db.chat_summaries.find_one(
+            {"chat_id": chat_id, "user_id": user_id},
+            {"_id": 0, "unread_count": 1, "last_read_at": 1, "last_message_time": 1, "is_group": 1},
+        )
+        if summary is None:
+            return None
+        now = datetime.now()
+        position = stored_time(min(read_at, now) if read_at else now)
+        if summary.get("last_read_at") and summary["last_read_at"] > position:
+            position = summary["last_read_at"]
+
+        if summary.get("last_message_time") is None or summary["last_message_time"] <= position:
+            unread = 0
+        else:
+            unread = await message_store.count_after(db, chat_id, position, user_id)
+
+        # unread_count only changes through this $set or a send's $inc: if it still holds
+        # the value read above, no message was counted in between
+        result = await db.chat_summaries.update_one(
+            {"chat_id": chat_id, "user_id": user_id, "unread_count": summary["unread_count"]},
+            {"$set": {"unread_count": unread, "last_read_at": position}, "$inc": {"version": 1}},
+        )
+        if result.matched_count:
+            return {
+                "chat_id": chat_id,
+                "unread_count": unread,
+                "last_read_at": position,
+                "advanced": position != summary.get("last_read_at"),
+                "is_group": summary.get("is_group", False),
+            }
+    raise HTTPException(status_code=503, detail="Chat is busy, try again", headers={"Retry-After": "1"})
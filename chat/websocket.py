@@ -1,77 +1,271 @@
-from fastapi import Request, HTTPException
+from fastapi import Request, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-import json
+from pydantic import BaseModel, Field, ValidationError
+import time
+import zlib
+import orjson
+import uuid
 import asyncio
+import logging
+import traceback
 from database import get_db
+from erroremail import error_notifier
+from admission import admission
+from config import (
+    SSE_QUEUE_SIZE, SSE_OVERFLOW_POLICY,
+    SSE_RETRY_MS, SSE_REPLAY_BUFFER_SIZE, SSE_REPLAY_USERS, SSE_REPLAY_FALLBACK_LIMIT,
+    WS_PING_INTERVAL_SECONDS, WS_COMPRESS_MIN_BYTES, MESSAGE_MAX_LENGTH,
+)
 from chat.models import Message
-from bson import ObjectId
-from typing import Dict
+from chat.broker import Broker, create_broker
+from chat.fanout import FanoutScheduler
+from chat.cache import forget_participants, get_participants, get_sender_summary, get_sender_summaries
+from chat.writer import message_writer
+from chat.store import message_store
+from chat.presence import PresenceService
+from chat.sse import Frame, ReplayRing, encode_event, next_event_id, event_id_floor, event_id_time, KEEPALIVE
+from auth.utils import authenticate_token
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+class Connection:
+    """
+    One live stream of a user, with its own bounded delivery queue.
+    When the queue is full the overflow policy decides what happens:
+      - drop_oldest: discard the oldest queued message
+      - coalesce: replace the backlog with one "resync" event naming the affected chats,
+        so the client refetches them through the history endpoint
+      - disconnect: close the stream of the slow consumer
+    """
+
+    def __init__(self, user_id: str, maxsize: int = SSE_QUEUE_SIZE, policy: str = SSE_OVERFLOW_POLICY):
+        self.connection_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.policy = policy
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.closed = False
+        self.dropped = 0
+        self.delivered = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._resync_chat_ids = set()  # chats named by a resync frame still in the queue
+
+    def offer(self, frame: Frame):
+        """Enqueue without blocking the sender, applying the overflow policy when full."""
+        if self.closed:
+            return
+        item = (time.monotonic(), frame)
+        if not self.queue.full():
+            self.queue.put_nowait(item)
+            return
+
+        if self.policy == "disconnect":
+            self.close()
+        elif self.policy == "coalesce":
+            chat_ids = set(self._resync_chat_ids)
+            chat_ids.add(frame.chat_id)
+            while not self.queue.empty():
+                _, queued = self.queue.get_nowait()
+                self.dropped += 1
+                chat_ids.add(queued.chat_id)
+            chat_ids.discard(None)
+            self._resync_chat_ids = chat_ids
+            self.queue.put_nowait((item[0], encode_event({"type": "resync", "chat_ids": sorted(chat_ids)})))
+        else:
+            self.queue.get_nowait()
+            self.dropped += 1
+            self.queue.put_nowait(item)
+
+    async def get(self) -> Optional[Frame]:
+        """Next frame, or None once the connection has been closed."""
+        enqueued_at, message = await self.queue.get()
+        if message is None:
+            return None
+        self._resync_chat_ids = set()
+        self.delivered += 1
+        self.last_lag = time.monotonic() - enqueued_at
+        self.max_lag = max(self.max_lag, self.last_lag)
+        return message
+
+    def close(self):
+        """Drop the backlog and wake the stream so it ends."""
+        self.closed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait((time.monotonic(), None))
+
+    def stats(self) -> dict:
+        return {
+            "connection_id": self.connection_id,
+            "queued": self.queue.qsize(),
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "last_lag_ms": round(self.last_lag * 1000, 2),
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+        }
 
 
 class ConnectionManager:
-    def __init__(self):
-        self.message_queues: Dict[str, asyncio.Queue] = {}
-
-    async def connect(self, user_id: str) -> asyncio.Queue:
-        """Create a message queue for the user"""
-        if user_id not in self.message_queues:
-            self.message_queues[user_id] = asyncio.Queue()
-        return self.message_queues[user_id]
-
-    def disconnect(self, user_id: str):
-        """Remove user's message queue"""
-        self.message_queues.pop(user_id, None)
-
-    async def send_message_to_chat(self, message: dict, chat_id: str):
-        """Send message to all participants in a chat"""
-        db = await get_db()
-        chat = await db.chats.find_one({"chat_id": chat_id})
-        if chat:
-            for participant_id in chat.get("participants", []):
-                queue = self.message_queues.get(participant_id)
-                if queue:
-                    try:
-                        await queue.put(message)
-                    except Exception as e:
-                        print(f"Error sending message to {participant_id}: {e}")
-
-    def _serialize(self, obj: dict) -> dict:
-        """Convert ObjectId and datetime to JSON-serializable format."""
-        serialized = {}
-        for k, v in obj.items():
-            if isinstance(v, ObjectId):
-                serialized[k] = str(v)
-            elif hasattr(v, "isoformat"):  # datetime
-                serialized[k] = v.isoformat()
-            elif isinstance(v, dict):
-                serialized[k] = self._serialize(v)
-            else:
-                serialized[k] = v
-        return serialized
+    def __init__(self, broker: Broker, presence: PresenceService):
+        # user_id -> connection_id -> Connection (one per open tab/device)
+        self.connections: Dict[str, Dict[str, Connection]] = {}
+        # user_id -> recent frames for Last-Event-ID replay, kept for the most recently connected users
+        self.replay: "OrderedDict[str, ReplayRing]" = OrderedDict()
+        self.broker = broker
+        self.presence = presence
+        self.fanout = FanoutScheduler(broker.publish)
+        self._started = False
+
+    async def start(self):
+        """Subscribe this process to the broker so it receives messages published by any worker."""
+        if not self._started:
+            self._started = True
+            await self.broker.start(self.deliver_local)
+            self.fanout.start()
+            self.presence.start(self.is_connected, self.broker.publish)
+
+    async def stop(self):
+        if self._started:
+            self._started = False
+            await self.presence.stop()
+            await self.fanout.stop()
+            await self.broker.stop()
+
+    async def connect(self, user_id: str) -> Connection:
+        """Register a new connection (with its own queue) for the user"""
+        connection = Connection(user_id)
+        self.connections.setdefault(user_id, {})[connection.connection_id] = connection
+        if user_id not in self.replay:
+            self.replay[user_id] = ReplayRing(SSE_REPLAY_BUFFER_SIZE)
+            while len(self.replay) > SSE_REPLAY_USERS:
+                self.replay.popitem(last=False)
+        self.replay.move_to_end(user_id)
+        self.presence.heartbeat(user_id)
+        return connection
+
+    def disconnect(self, connection: Connection):
+        """Remove one connection; the user's other connections keep receiving"""
+        user_connections = self.connections.get(connection.user_id, {})
+        user_connections.pop(connection.connection_id, None)
+        if not user_connections:
+            self.connections.pop(connection.user_id, None)
+            self.presence.offline(connection.user_id)
+
+    def is_connected(self, user_id: str) -> bool:
+        return bool(self.connections.get(user_id))
+
+    def stats(self, slowest: int = 10) -> dict:
+        """Connection counts, queue depths and the connections with the deepest backlog"""
+        connections = [c for user_connections in self.connections.values() for c in user_connections.values()]
+        connections.sort(key=lambda c: c.queue.qsize(), reverse=True)
+        return {
+            "users": len(self.connections),
+            "connections": len(connections),
+            "queued": sum(c.queue.qsize() for c in connections),
+            "dropped": sum(c.dropped for c in connections),
+            "overflow_policy": SSE_OVERFLOW_POLICY,
+            "queue_size": SSE_QUEUE_SIZE,
+            "replay_users": len(self.replay),
+            "slowest": [c.stats() for c in connections[:slowest]],
+        }
 
+    async def send_message_to_chat(self, message: dict, chat_id: str, event_id: Optional[int] = None):
+        """Queue message for all participants in a chat, on whichever worker they are connected"""
+        participants = await get_participants(await get_db(), chat_id)  # cached after the access check
+        if participants:
+            await self.start()  # no-op once the lifespan has subscribed
+            # Encoded once here; every recipient queue shares the same immutable frame.
+            # The fan-out scheduler delivers it in batches after the sender's request returns
+            self.fanout.submit(participants, encode_event(message, event_id))
 
-manager = ConnectionManager()
+    async def deliver_local(self, recipients: List[str], frame: Frame):
+        """Broker handler: put the frame on the queues of recipients connected to this process"""
+        if frame.event_type == "members":
+            forget_participants(frame.chat_id)  # membership changed, possibly on another worker
+        for participant_id in recipients:
+            if frame.event_id is not None and participant_id in self.replay:
+                self.replay[participant_id].append(frame)
+            for connection in list(self.connections.get(participant_id, {}).values()):
+                connection.offer(frame)
 
+    async def replay_since(self, db, user_id: str, last_event_id: int) -> List[Frame]:
+        """
+        Frames the user missed after `last_event_id`: from the in-memory ring when it still
+        covers the gap, otherwise rebuilt from the message store by timestamp.
+        """
+        ring = self.replay.get(user_id)
+        if ring is not None and ring.covers(last_event_id):
+            return ring.after(last_event_id)
 
-async def sse_endpoint(request: Request, user_id: str):
+        chat_ids = [
+            summary["chat_id"]
+            async for summary in db.chat_summaries.find({"user_id": user_id}, {"_id": 0, "chat_id": 1})
+        ]
+        messages = await message_store.since(db, chat_ids, event_id_time(last_event_id), SSE_REPLAY_FALLBACK_LIMIT + 1)
+
+        if len(messages) > SSE_REPLAY_FALLBACK_LIMIT:
+            # Too far behind to replay; let the client refetch history for its chats
+            return [encode_event({"type": "resync", "chat_ids": sorted({m["chat_id"] for m in messages})})]
+
+        senders = await get_sender_summaries(db, (m["sender_id"] for m in messages))
+        frames = []
+        for m in messages:
+            frames.append(encode_event(message_event(Message(**m), senders.get(m["sender_id"])),
+                                       event_id_floor(m["timestamp"])))
+        return frames
+
+
+def message_event(message: Message, sender: Optional[dict]) -> dict:
+    """The event pushed to chat participants for a new message"""
+    return {
+        "type": "message",
+        "message_id": str(message.message_id),
+        "chat_id": message.chat_id,
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+        "sender": sender
+    }
+
+
+presence = PresenceService(get_db)
+manager = ConnectionManager(create_broker(get_db), presence)
+
+
+def _parse_last_event_id(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+async def sse_endpoint(request: Request, user_id: str, db):
     """
     SSE endpoint for receiving real-time messages
     Usage: GET /sse/{user_id}
+    Message events carry an `id:`; on reconnect the browser sends it back as Last-Event-ID
+    (or pass ?last_event_id=) and the missed messages are replayed before live ones.
     """
-    db = await get_db()
-
-    # Update user online status
-    await db.users.update_one(
-        {"user_id": user_id},
-        {"$set": {"is_online": True}}
+    last_event_id = _parse_last_event_id(
+        request.headers.get("last-event-id") or request.query_params.get("last_event_id")
     )
 
     async def event_generator():
-        queue = await manager.connect(user_id)
+        connection = await manager.connect(user_id)
         try:
-            # Send initial connection message
-            yield f"data: {json.dumps({'type': 'connected', 'user_id': user_id})}\n\n"
+            # Send the reconnect delay hint and the initial connection message
+            yield b"retry: %d\n\n" % SSE_RETRY_MS
+            yield encode_event({"type": "connected", "user_id": user_id}).data
+
+            # Replay what was missed; live frames already queued for those events are skipped.
+            # Ids of different workers are not ordered, so dedup by id rather than a high-water mark
+            replayed = set()
+            if last_event_id is not None:
+                for frame in await manager.replay_since(db, user_id, last_event_id):
+                    yield frame.data
+                    if frame.event_id is not None:
+                        replayed.add(frame.event_id)
 
             while True:
                 # Check if client disconnected
@@ -80,22 +274,21 @@ async def sse_endpoint(request: Request, user_id: str):
 
                 try:
                     # Wait for messages with timeout to allow checking disconnect
-                    message = await asyncio.wait_for(queue.get(), timeout=30.0)
-                    serialized_message = manager._serialize(message)
-                    yield f"data: {json.dumps(serialized_message)}\n\n"
+                    frame = await asyncio.wait_for(connection.get(), timeout=30.0)
+                    if frame is None:
+                        break  # closed as a slow consumer
+                    if frame.event_id in replayed:
+                        replayed.discard(frame.event_id)
+                        continue
+                    yield frame.data
                 except asyncio.TimeoutError:
                     # Send keepalive ping every 30 seconds
-                    yield f": keepalive\n\n"
+                    yield KEEPALIVE
 
         except Exception as e:
             print(f"SSE Error for user {user_id}: {e}")
         finally:
-            # Cleanup on disconnect
-            manager.disconnect(user_id)
-            await db.users.update_one(
-                {"user_id": user_id},
-                {"$set": {"is_online": False}}
-            )
+            manager.disconnect(connection)
 
     return StreamingResponse(
         event_generator(),
@@ -111,24 +304,35 @@ async def sse_endpoint(request: Request, user_id: str):
 # Pydantic model for sending messages
 class SendMessageRequest(BaseModel):
     chat_id: str
-    content: str
+    content: str = Field(max_length=MESSAGE_MAX_LENGTH)
 
 
-async def send_message_endpoint(user_id: str, message_request: SendMessageRequest):
+async def send_message_endpoint(user_id: str, message_request: SendMessageRequest, db):
     """
     REST endpoint for sending messages
     Usage: POST /send/{user_id}
     Body: {"chat_id": "...", "content": "..."}
     """
-    db = await get_db()
+    message = await send_chat_message(db, user_id, message_request)
+    return {
+        "status": "success",
+        "message_id": str(message.message_id),
+        "timestamp": message.timestamp.isoformat()
+    }
+
+
+async def send_chat_message(db, user_id: str, message_request: SendMessageRequest) -> Message:
+    """Store a message and fan it out; shared by the REST and WebSocket transports"""
+    await admission.admit("send", user_id)
 
     # Verify user has access to chat
-    chat = await db.chats.find_one({"chat_id": message_request.chat_id})
-    if not chat:
+    participants = await get_participants(db, message_request.chat_id)
+    if participants is None:
         raise HTTPException(status_code=404, detail="Chat not found")
 
-    if user_id not in chat.get("participants", []):
+    if user_id not in participants:
         raise HTTPException(status_code=403, detail="User not in chat")
+    manager.fanout.admit()
 
     # Create Message Pydantic model
     message = Message(
@@ -137,38 +341,140 @@ async def send_message_endpoint(user_id: str, message_request: SendMessageReques
         content=message_request.content
     )
 
-    await db.messages.insert_one(message.model_dump())
+    # Batched mode only queues the write: deliver right away, then wait for the flush if configured
+    flushed = await message_writer.write(db, message)
 
-    # Update chat's last message
-    await db.chats.update_one(
-        {"chat_id": message_request.chat_id},
-        {
-            "$set": {
-                "last_message": message_request.content,
-                "last_message_time": message.timestamp
-            }
-        }
+    # Prepare broadcast message
+    sender = await get_sender_summary(db, user_id)
+    broadcast = message_event(message, sender)
+
+    # Broadcast to all participants
+    await manager.send_message_to_chat(broadcast, message.chat_id, next_event_id(message.timestamp))
+    await message_writer.acknowledge(flushed)
+    return message
+
+
+def _report_ws_error(user_id: str, error: Exception):
+    """Log an unexpected /ws failure and queue it to the error notifier, like HTTP 500s."""
+    logging.error(f"WebSocket Error for user {user_id}: {error}")
+    tb = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+    error_notifier.notify(
+        "🚨 WebSocket Unhandled Exception",
+        f"User: {user_id}\nError: {error}\n\nFull Traceback:\n{tb}",
+        error_notifier.fingerprint("WS", "/ws", "exception", tb),
     )
 
-    # Prepare broadcast message
-    sender_doc = await db.users.find_one({"user_id": user_id})
-    if sender_doc:
-        sender_doc.pop("password_hash", None)  # remove sensitive info
 
-    broadcast = {
-        "type": "message",
-        "message_id": str(message.message_id),
-        "chat_id": message.chat_id,
-        "content": message.content,
-        "timestamp": message.timestamp.isoformat(),
-        "sender": manager._serialize(sender_doc) if sender_doc else None
-    }
+async def websocket_endpoint(websocket: WebSocket, db):
+    """
+    WebSocket transport sharing ConnectionManager and the send path with REST + SSE
+    Usage: WS /ws?token=<jwt>[&compress=1][&last_event_id=<id>]
+    Client frames: {"type": "send", "chat_id": "...", "content": "...", "client_id": "..."},
+                   {"type": "ping"}, {"type": "pong"}
+    Server frames: the same events as SSE, {"type": "ack", ...}, {"type": "error", ...},
+                   {"type": "ping"}, {"type": "pong"}
+    With compress=1, frames of WS_COMPRESS_MIN_BYTES or more are sent as zlib-compressed binary.
+    """
+    try:
+        user = await authenticate_token(websocket.query_params.get("token") or "", db)
+    except HTTPException as e:
+        await websocket.close(code=4401, reason=e.detail)
+        return
+    user_id = user.user_id
+    compress = websocket.query_params.get("compress") in ("1", "true")
+    last_event_id = _parse_last_event_id(websocket.query_params.get("last_event_id"))
 
-    # Broadcast to all participants
-    await manager.send_message_to_chat(broadcast, message.chat_id)
+    await websocket.accept()
+    connection = await manager.connect(user_id)
+    send_lock = asyncio.Lock()
+    last_received = time.monotonic()
 
-    return {
-        "status": "success",
-        "message_id": str(message.message_id),
-        "timestamp": message.timestamp.isoformat()
-    }
+    async def send(payload: bytes):
+        async with send_lock:
+            if compress and len(payload) >= WS_COMPRESS_MIN_BYTES:
+                await websocket.send_bytes(zlib.compress(payload))
+            else:
+                await websocket.send_text(payload.decode())
+
+    async def reader():
+        nonlocal last_received
+        while True:
+            raw = await websocket.receive_text()
+            last_received = time.monotonic()
+            try:
+                frame = orjson.loads(raw)
+                kind = frame.get("type")
+            except (orjson.JSONDecodeError, AttributeError):
+                await send(orjson.dumps({"type": "error", "status": 400, "detail": "Invalid frame"}))
+                continue
+
+            if kind == "send":
+                try:
+                    message = await send_chat_message(db, user_id, SendMessageRequest(**frame))
+                except ValidationError:
+                    await send(orjson.dumps({
+                        "type": "error", "status": 422, "client_id": frame.get("client_id"),
+                        "detail": f"chat_id and content (at most {MESSAGE_MAX_LENGTH} characters) are required",
+                    }))
+                    continue
+                except HTTPException as e:
+                    error = {"type": "error", "status": e.status_code, "client_id": frame.get("client_id"),
+                             "detail": e.detail}
+                    if e.headers and "Retry-After" in e.headers:
+                        error["retry_after"] = int(e.headers["Retry-After"])
+                    await send(orjson.dumps(error))
+                    continue
+                except Exception as e:
+                    _report_ws_error(user_id, e)
+                    await send(orjson.dumps({
+                        "type": "error", "status": 500, "client_id": frame.get("client_id"),
+                        "detail": "Failed to send message",
+                    }))
+                    continue
+                await send(orjson.dumps({
+                    "type": "ack",
+                    "client_id": frame.get("client_id"),
+                    "message_id": message.message_id,
+                    "timestamp": message.timestamp,
+                }))
+            elif kind == "ping":
+                await send(b'{"type":"pong"}')
+
+    async def writer():
+        replayed = set()
+        if last_event_id is not None:
+            for frame in await manager.replay_since(db, user_id, last_event_id):
+                await send(frame.json)
+                if frame.event_id is not None:
+                    replayed.add(frame.event_id)
+
+        while True:
+            try:
+                frame = await asyncio.wait_for(connection.get(), timeout=WS_PING_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                if time.monotonic() - last_received > 2 * WS_PING_INTERVAL_SECONDS:
+                    await websocket.close(code=1001, reason="Ping timeout")
+                    return
+                await send(b'{"type":"ping"}')
+                continue
+            if frame is None:
+                await websocket.close(code=1013, reason="Slow consumer")
+                return
+            if frame.event_id in replayed:
+                replayed.discard(frame.event_id)
+                continue
+            await send(frame.json)
+
+    tasks = [asyncio.create_task(reader()), asyncio.create_task(writer())]
+    try:
+        await send(orjson.dumps({"type": "connected", "user_id": user_id}))
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() and not isinstance(task.exception(), WebSocketDisconnect):
+                _report_ws_error(user_id, task.exception())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        manager.disconnect(connection)
@@ -0,0 +1,251 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+from fastapi import HTTPException
+from pymongo import UpdateOne
+from pymongo.errors import ConnectionFailure, ExecutionTimeout, PyMongoError, WTimeoutError
+from database import get_db
+from chat.models import Message
+from chat.summaries import summary_updates
+from chat.store import message_store
+from config import (
+    MESSAGE_WRITE_MODE, MESSAGE_WRITE_ACK, MESSAGE_FLUSH_INTERVAL_MS,
+    MESSAGE_FLUSH_MAX_BATCH, MESSAGE_WRITE_MAX_PENDING,
+)
+
+
+def _transient(error: Exception) -> bool:
+    """Whether writing the same batch again may succeed (network, failover, timeouts)."""
+    if isinstance(error, (ConnectionFailure, ExecutionTimeout, WTimeoutError)):
+        return True
+    return isinstance(error, PyMongoError) and error.has_error_label("RetryableWriteError")
+
+
+def _chat_update(message: Message) -> dict:
+    return {
+        "last_message": message.content,
+        "last_message_time": message.timestamp,
+        "last_sender_id": message.sender_id,
+        "last_activity": message.timestamp,
+    }
+
+
+class MessageWriter:
+    """
+    Persists sent messages, the chat's last_message fields and the members'
+    chat summaries (chat.summaries).
+
+    Messages go to the configured chat.store engine.
+
+    direct:  one insert + update_one per message before it is delivered; the summary
+             bulk_write runs in the background, since for a large group it touches
+             every member's summary
+    batched: messages are queued and written with one insert per flush window
+             (MESSAGE_FLUSH_INTERVAL_MS, or sooner once MESSAGE_FLUSH_MAX_BATCH are queued);
+             chat updates are collapsed to the newest message per chat_id.
+             If a batch fails, with ack "flush" its waiting senders get the error; with ack
+             "queue" it is requeued for the next flush when the error is transient (stores
+             ignore a message_id stored twice, so the retry is idempotent) and otherwise
+             parked: logged, counted and kept in `parked` instead of retried forever.
+             Summaries are written after the messages; if that step fails the counters
+             are not retried, since $inc is not idempotent, and the next mark-read
+             recounts them from the message store.
+    """
+
+    def __init__(self, get_db, mode: str = MESSAGE_WRITE_MODE, ack: str = MESSAGE_WRITE_ACK,
+                 interval_ms: int = MESSAGE_FLUSH_INTERVAL_MS, max_batch: int = MESSAGE_FLUSH_MAX_BATCH,
+                 max_pending: int = MESSAGE_WRITE_MAX_PENDING):
+        self.get_db = get_db
+        self.mode = mode
+        self.ack = ack
+        self.interval = interval_ms / 1000
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self._messages: List[dict] = []
+        self._chats: Dict[str, dict] = {}  # chat_id -> $set of the newest queued message
+        # chat_id -> (sender_id, timestamp) of each queued message
+        self._sent: Dict[str, List[Tuple[str, datetime]]] = {}
+        self._summary_writes: Set[asyncio.Task] = set()  # direct mode
+        self._flushed: Optional[asyncio.Future] = None  # resolved when the queued batch is stored
+        self._queued = asyncio.Event()
+        self._full = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._worker: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.parked: deque = deque(maxlen=max_pending)  # ack "queue" batches that failed for good
+        self._flush_ms = deque(maxlen=1000)
+        self.batches = 0
+        self.written = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.summary_failures = 0
+        self.rejected = 0
+
+    @property
+    def batched(self) -> bool:
+        return self.mode == "batched"
+
+    def start(self):
+        if self.batched and (self._worker is None or self._worker.done()):
+            self._stopping = False
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flush loop and write whatever is still queued."""
+        if self._worker is not None:
+            # Wake the loop instead of cancelling it, so a batch is never abandoned mid-write
+            self._stopping = True
+            self._queued.set()
+            self._full.set()
+            await self._worker
+            self._worker = None
+        await self.flush()
+        if self._summary_writes:
+            await asyncio.gather(*self._summary_writes)
+        if self._messages:
+            logging.error(f"Message writer stopped with {len(self._messages)} unsaved messages")
+
+    async def write(self, db, message: Message) -> Optional[asyncio.Future]:
+        """
+        Direct mode: store the message now. Batched mode: queue it and, with ack "flush",
+        return a future resolved once its batch is stored (see `acknowledge`).
+        """
+        if not self.batched:
+            await message_store.insert(db, [message.model_dump()])
+            await db.chats.update_one({"chat_id": message.chat_id}, {"$set": _chat_update(message)})
+            task = asyncio.create_task(self._write_summaries(db, summary_updates(
+                message.chat_id, _chat_update(message), [(message.sender_id, message.timestamp)]
+            ), 1))
+            self._summary_writes.add(task)
+            task.add_done_callback(self._summary_writes.discard)
+            return None
+
+        self.start()
+        if len(self._messages) >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Server busy, try again", headers={"Retry-After": "1"})
+
+        self._messages.append(message.model_dump())
+        queued = self._chats.get(message.chat_id)
+        if queued is not None:
+            self.coalesced += 1
+        if queued is None or queued["last_message_time"] <= message.timestamp:
+            self._chats[message.chat_id] = _chat_update(message)
+        self._sent.setdefault(message.chat_id, []).append((message.sender_id, message.timestamp))
+        self._queued.set()
+        if len(self._messages) >= self.max_batch:
+            self._full.set()
+
+        if self.ack != "flush":
+            return None
+        if self._flushed is None:
+            self._flushed = asyncio.get_running_loop().create_future()
+        return self._flushed
+
+    async def acknowledge(self, flushed: Optional[asyncio.Future]):
+        """Wait until the batch is stored; raises the write error if it failed."""
+        if flushed is not None:
+            # Shielded: one cancelled request must not cancel the batch for everyone else
+            await asyncio.shield(flushed)
+
+    async def _run(self):
+        while not self._stopping:
+            await self._queued.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                # The loop must outlive any one batch, or queued messages would never be written
+                logging.error(f"Message flush loop error: {e}")
+
+    async def flush(self):
+        async with self._lock:
+            if not self._messages:
+                return
+            messages, self._messages = self._messages, []
+            chats, self._chats = self._chats, {}
+            sent, self._sent = self._sent, {}
+            flushed, self._flushed = self._flushed, None
+            self._queued.clear()
+            self._full.clear()
+
+            started = time.perf_counter()
+            try:
+                db = await self.get_db()
+                await message_store.insert(db, messages)
+                if chats:
+                    await db.chats.bulk_write(
+                        [UpdateOne({"chat_id": chat_id}, {"$set": fields}) for chat_id, fields in chats.items()],
+                        ordered=False,
+                    )
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Failed to write {len(messages)} messages: {e!r}")
+                if flushed is not None:
+                    flushed.set_exception(e)
+                elif _transient(e):
+                    self._requeue(messages, chats, sent)
+                else:
+                    self.parked.extend(messages)
+                    logging.error(f"Parked {len(messages)} unwritable messages: "
+                                  f"{', '.join(m['message_id'] for m in messages)}")
+                return
+
+            try:
+                await self._write_summaries(db, [
+                    update for chat_id, chat_sent in sent.items()
+                    for update in summary_updates(chat_id, chats[chat_id], chat_sent)
+                ], len(chats))
+            finally:
+                # The messages are stored whatever happened to the summaries
+                self._flush_ms.append((time.perf_counter() - started) * 1000)
+                self.batches += 1
+                self.written += len(messages)
+                if flushed is not None:
+                    flushed.set_result(None)
+
+    async def _write_summaries(self, db, updates: list, chats: int):
+        try:
+            if updates:
+                await db.chat_summaries.bulk_write(updates, ordered=False)
+        except Exception as e:
+            self.summary_failures += 1
+            logging.error(f"Failed to update chat summaries for {chats} chats: {e}")
+
+    def _requeue(self, messages: List[dict], chats: Dict[str, dict], sent: Dict[str, List[Tuple[str, datetime]]]):
+        self._messages[:0] = messages
+        for chat_id, fields in chats.items():
+            queued = self._chats.get(chat_id)
+            if queued is None or queued["last_message_time"] < fields["last_message_time"]:
+                self._chats[chat_id] = fields
+        for chat_id, chat_sent in sent.items():
+            self._sent.setdefault(chat_id, [])[:0] = chat_sent
+        self._queued.set()
+
+    def stats(self) -> dict:
+        flush_ms = sorted(self._flush_ms)
+        return {
+            "mode": self.mode,
+            "ack": self.ack,
+            "pending": len(self._messages),
+            "batches": self.batches,
+            "written": self.written,
+            "avg_batch_size": round(self.written / self.batches, 1) if self.batches else None,
+            "coalesced_chat_updates": self.coalesced,
+            "failed_batches": self.failed,
+            "parked": len(self.parked),
+            "pending_summary_updates": len(self._summary_writes),
+            "failed_summary_updates": self.summary_failures,
+            "rejected": self.rejected,
+            "flush_ms_p50": round(flush_ms[len(flush_ms) // 2], 2) if flush_ms else None,
+            "flush_ms_max": round(flush_ms[-1], 2) if flush_ms else None,
+        }
+
+
+message_writer = MessageWriter(get_db)
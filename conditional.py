@@ -0,0 +1,35 @@
+"""
+Conditional GET for polled endpoints. ETags are built from stored version fields
+(see chat.summaries.chat_list_version and Chat.last_message_time), so an unchanged
+poll is answered with 304 after one small indexed read instead of the full queries.
+"""
+from typing import Optional
+from fastapi import Request
+from fastapi.responses import Response
+
+# Clients keep the response but revalidate it on every use; never stored by shared caches
+CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(*parts) -> str:
+    """Weak ETag: the body is the same for equal versions, its encoding may not be."""
+    return 'W/"' + "-".join(str(part) for part in parts) + '"'
+
+
+def cache_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+
+
+def _opaque(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """A 304 response if the request's If-None-Match names `etag` (weak comparison), else None."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return None
+    if header.strip() == "*" or _opaque(etag) in {_opaque(tag) for tag in header.split(",")}:
+        return Response(status_code=304, headers=cache_headers(etag))
+    return None
@@ -1,12 +1,138 @@
+from collections import defaultdict
+from typing import Dict, Optional
 from motor.motor_asyncio import AsyncIOMotorClient
-from config import mongo_url, db_name
+from pymongo import monitoring
+from metrics import mongo_commands, mongo_command_duration
+from config import (
+    mongo_url, db_name,
+    MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_MAX_IDLE_TIME_MS,
+    MONGO_CONNECT_TIMEOUT_MS, MONGO_SOCKET_TIMEOUT_MS,
+    MONGO_SERVER_SELECTION_TIMEOUT_MS, MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    MONGO_READ_PREFERENCE,
+)
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Collect per-server connection pool counters for sizing the pool."""
+
+    def __init__(self):
+        self.pools: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def _bump(self, event, key: str, delta: int = 1):
+        self.pools[f"{event.address[0]}:{event.address[1]}"][key] += delta
+
+    def pool_created(self, event):
+        self._bump(event, "pools_created")
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._bump(event, "pools_cleared")
+
+    def pool_closed(self, event):
+        self._bump(event, "pools_closed")
+
+    def connection_created(self, event):
+        self._bump(event, "connections_created")
+        self._bump(event, "open_connections")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._bump(event, "connections_closed")
+        self._bump(event, "open_connections", -1)
+
+    def connection_check_out_started(self, event):
+        self._bump(event, "waiting")
+
+    def connection_check_out_failed(self, event):
+        self._bump(event, "waiting", -1)
+        self._bump(event, "checkout_failures")
+
+    def connection_checked_out(self, event):
+        self._bump(event, "waiting", -1)
+        self._bump(event, "checked_out")
+        self._bump(event, "checkouts")
+
+    def connection_checked_in(self, event):
+        self._bump(event, "checked_out", -1)
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        return {address: dict(counters) for address, counters in self.pools.items()}
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """Count MongoDB commands and their duration per command name and collection."""
+
+    def __init__(self):
+        self._started: Dict[tuple, tuple] = {}  # (connection, request_id) -> (command, collection)
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ""  # e.g. getMore carries a cursor id, admin commands a 1
+        if event.command_name == "getMore":
+            collection = event.command.get("collection", "")
+        self._started[(event.connection_id, event.request_id)] = (event.command_name, collection)
+
+    def _finished(self, event, outcome: str):
+        command, collection = self._started.pop(
+            (event.connection_id, event.request_id), (event.command_name, "")
+        )
+        mongo_commands.inc(command, collection, outcome)
+        mongo_command_duration.observe(event.duration_micros / 1e6, command, collection)
+
+    def succeeded(self, event):
+        self._finished(event, "success")
+
+    def failed(self, event):
+        self._finished(event, "failure")
+
+
+pool_stats = PoolStatsListener()
+command_metrics = CommandMetricsListener()
+client: Optional[AsyncIOMotorClient] = None
+
+
+def connect_db() -> AsyncIOMotorClient:
+    """Create the shared Motor client (one connection pool per server)."""
+    global client
+    if client is None:
+        client = AsyncIOMotorClient(
+            mongo_url,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+            connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+            socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+            readPreference=MONGO_READ_PREFERENCE,
+            event_listeners=[pool_stats, command_metrics],
+        )
+    return client
+
+
+def close_db():
+    """Close the shared client on application shutdown."""
+    global client
+    if client is not None:
+        client.close()
+        client = None
+
 
 async def get_db():
-    """Return a database instance per request."""
-    client = AsyncIOMotorClient(mongo_url)
-    db = client[db_name]
-    return db
+    """Return the shared database instance (usable as a FastAPI dependency)."""
+    return connect_db()[db_name]
 
 
-# async def close_db():
-#     client.close()
+def get_pool_stats() -> dict:
+    """Return pool configuration and per-server pool counters."""
+    return {
+        "max_pool_size": MONGO_MAX_POOL_SIZE,
+        "min_pool_size": MONGO_MIN_POOL_SIZE,
+        "read_preference": MONGO_READ_PREFERENCE,
+        "pools": pool_stats.snapshot(),
+    }
@@ -1,5 +1,9 @@
 import os
+import asyncio
+import hashlib
 import logging
+from collections import OrderedDict
+from typing import List, Optional
 from dotenv import load_dotenv
 import smtplib
 from email.mime.text import MIMEText
@@ -15,21 +19,164 @@ SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASS = os.getenv("SMTP_PASS")
 ADMIN_EMAIL = os.getenv("ADMIN_EMAIL")
 
+# Notifier settings: at most one digest email per interval, bounded backlog
+ERROR_DIGEST_INTERVAL_SECONDS = float(os.getenv("ERROR_DIGEST_INTERVAL_SECONDS", "60"))
+ERROR_QUEUE_SIZE = int(os.getenv("ERROR_QUEUE_SIZE", "1000"))
 
-def send_error_email(subject: str, body: str):
-    """Send an email with error details."""
-    try:
-        msg = MIMEMultipart()
-        msg["From"] = SMTP_USER
-        msg["To"] = ADMIN_EMAIL
-        msg["Subject"] = subject
 
-        msg.attach(MIMEText(body, "plain"))
+def _build_message(subject: str, body: str) -> MIMEMultipart:
+    msg = MIMEMultipart()
+    msg["From"] = SMTP_USER
+    msg["To"] = ADMIN_EMAIL
+    msg["Subject"] = subject
+    msg.attach(MIMEText(body, "plain"))
+    return msg
 
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SMTP_USER, SMTP_PASS)
-            server.sendmail(SMTP_USER, ADMIN_EMAIL, msg.as_string())
-    except Exception as e:
-        logging.error(f"Failed to send error email: {e}")
 
+class SMTPSink:
+    """Delivers notifications over one SMTP connection that is kept open between sends."""
+
+    def __init__(self, server: str = SMTP_SERVER, port: int = SMTP_PORT):
+        self.server = server
+        self.port = port
+        self._conn: Optional[smtplib.SMTP] = None
+
+    def _connect(self) -> smtplib.SMTP:
+        conn = smtplib.SMTP(self.server, self.port, timeout=30)
+        conn.starttls()
+        conn.login(SMTP_USER, SMTP_PASS)
+        return conn
+
+    def send(self, subject: str, body: str):
+        msg = _build_message(subject, body).as_string()
+        for attempt in range(2):
+            try:
+                if self._conn is None:
+                    self._conn = self._connect()
+                self._conn.sendmail(SMTP_USER, ADMIN_EMAIL, msg)
+                return
+            except (smtplib.SMTPException, OSError):
+                # The server drops idle connections; reconnect once before giving up
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._conn = None
+
+
+class LogSink:
+    """Writes notifications to the log; used when SMTP is not configured."""
+
+    def send(self, subject: str, body: str):
+        logging.error(f"{subject}\n{body}")
+
+    def close(self):
+        pass
+
+
+class MemorySink:
+    """Keeps notifications in memory, for tests and local runs."""
+
+    def __init__(self):
+        self.sent: List[tuple] = []
+
+    def send(self, subject: str, body: str):
+        self.sent.append((subject, body))
+
+    def close(self):
+        pass
+
+
+class ErrorNotifier:
+    """
+    Background error notifications. `notify` only enqueues, so request latency never
+    depends on mail delivery. A worker drains the queue, groups events by fingerprint
+    and sends one digest per interval through the configured sink.
+    """
+
+    def __init__(self, sink, interval: float = ERROR_DIGEST_INTERVAL_SECONDS, queue_size: int = ERROR_QUEUE_SIZE):
+        self.sink = sink
+        self.interval = interval
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.sent = 0
+        self._pending: "OrderedDict[str, list]" = OrderedDict()  # fingerprint -> [subject, body, count]
+        self._worker: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def fingerprint(*parts: str) -> str:
+        return hashlib.sha1("\x1f".join(parts).encode()).hexdigest()
+
+    def notify(self, subject: str, body: str, fingerprint: Optional[str] = None):
+        try:
+            self.queue.put_nowait((fingerprint or self.fingerprint(subject, body), subject, body))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the worker and flush whatever is still queued."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        while not self.queue.empty():
+            self._add(self.queue.get_nowait())
+        await self._flush()
+        await asyncio.to_thread(self.sink.close)
+
+    def _add(self, event: tuple):
+        fingerprint, subject, body = event
+        if fingerprint in self._pending:
+            self._pending[fingerprint][2] += 1
+        else:
+            self._pending[fingerprint] = [subject, body, 1]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._add(await self.queue.get())
+            # Collect everything reported within the window into one digest
+            deadline = loop.time() + self.interval
+            while (remaining := deadline - loop.time()) > 0:
+                try:
+                    self._add(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush()
+
+    async def _flush(self):
+        if not self._pending:
+            return
+        events, self._pending = list(self._pending.values()), OrderedDict()
+
+        if len(events) == 1 and events[0][2] == 1:
+            subject, body = events[0][0], events[0][1]
+        else:
+            total = sum(count for _, _, count in events)
+            subject = f"🚨 FastAPI errors: {total} events ({len(events)} unique)"
+            body = "\n\n".join(f"[{count}x] {subject}\n{body}" for subject, body, count in events)
+            if self.dropped:
+                body += f"\n\n{self.dropped} events dropped (queue full)"
+                self.dropped = 0
+
+        try:
+            await asyncio.to_thread(self.sink.send, subject, body)
+            self.sent += 1
+        except Exception as e:
+            logging.error(f"Failed to send error email: {e}")
+
+
+error_notifier = ErrorNotifier(SMTPSink() if SMTP_USER else LogSink())
@@ -0,0 +1,237 @@
+"""
+Index registry for the users, chats, chat_summaries, messages, message_buckets and rate_limits
+collections.
+
+Usage:
+    python indexes.py           # create missing indexes (idempotent)
+    python indexes.py --check   # explain() every hot query, fail on COLLSCAN
+"""
+import sys
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List
+from pymongo import IndexModel, UpdateOne, ASCENDING, DESCENDING
+from users.search import search_keys
+from chat.summaries import new_summaries
+from chat.store import BucketStore
+
+# Indexes every collection needs, keyed by collection name
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("search_keys", ASCENDING)], name="search_keys"),
+        IndexModel([("created_at", ASCENDING)], name="created_at"),
+    ],
+    "chats": [
+        IndexModel([("chat_id", ASCENDING)], name="chat_id_unique", unique=True),
+        IndexModel(
+            [("participants", ASCENDING), ("last_activity", DESCENDING), ("chat_id", DESCENDING)],
+            name="participants_last_activity",
+        ),
+    ],
+    "chat_summaries": [
+        IndexModel([("chat_id", ASCENDING), ("user_id", ASCENDING)], name="chat_id_user_id_unique", unique=True),
+        IndexModel(
+            [("user_id", ASCENDING), ("last_activity", DESCENDING), ("chat_id", DESCENDING)],
+            name="user_id_last_activity",
+        ),
+        # Covers the chat-list ETag (chat.summaries.chat_list_version)
+        IndexModel([("user_id", ASCENDING), ("version", ASCENDING)], name="user_id_version"),
+    ],
+    "messages": [
+        IndexModel(
+            [("chat_id", ASCENDING), ("timestamp", ASCENDING), ("message_id", ASCENDING)],
+            name="chat_id_timestamp_message_id",
+        ),
+        IndexModel([("message_id", ASCENDING)], name="message_id_unique", unique=True),
+    ],
+    # MESSAGE_STORAGE=buckets (chat/store.py)
+    "message_buckets": [
+        IndexModel([("chat_id", ASCENDING), ("window", ASCENDING)], name="chat_id_window"),
+        IndexModel([("window", ASCENDING)], name="window"),
+        IndexModel([("chat_id", ASCENDING), ("message_ids", ASCENDING)], name="chat_id_message_ids"),
+    ],
+    # ADMISSION_STORE=mongo (admission.py): idle token buckets are removed once full again
+    "rate_limits": [
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+}
+
+# Queries issued on hot paths in auth/, chat/ and users/ that must be served by an index.
+# Each entry: (description, collection, filter, sort)
+HOT_QUERIES = [
+    ("auth.get_current_user / login", "users", {"username": "x"}, None),
+    ("auth.register duplicate check", "users", {"$or": [{"username": "x"}, {"email": "x@x.x"}]}, None),
+    ("sender lookup by user_id", "users", {"user_id": "x"}, None),
+    ("users.search_users", "users", {"search_keys": {"$regex": "^jo"}, "user_id": {"$ne": "x"}}, None),
+    ("chat.create_chat existing chat", "chats", {"participants": {"$all": ["a", "b"]}}, None),
+    ("chat.create_chat / presence partners", "chats", {"participants": "a"}, None),
+    ("chat.get_user_chats", "chat_summaries", {"user_id": "a"}, [("last_activity", DESCENDING), ("chat_id", DESCENDING)]),
+    ("chat list ETag", "chat_summaries", {"user_id": "a"}, [("version", ASCENDING)]),
+    ("chat summary preview update", "chat_summaries", {"chat_id": "x"}, None),
+    ("chat.mark_chat_read", "chat_summaries", {"chat_id": "x", "user_id": "a"}, None),
+    ("group members / chat.get_chat_members", "chat_summaries", {"chat_id": "x"}, [("user_id", ASCENDING)]),
+    ("unread counters", "chat_summaries", {"chat_id": "x", "user_id": {"$ne": "a"}}, None),
+    ("sse replay chats", "chat_summaries", {"user_id": "a"}, None),
+    ("chat lookup by chat_id", "chats", {"chat_id": "x"}, None),
+    ("chat.get_chat_messages", "messages", {"chat_id": "x"}, [("timestamp", DESCENDING), ("message_id", DESCENDING)]),
+    ("chat.get_chat_messages (buckets)", "message_buckets", {"chat_id": "x"}, [("window", DESCENDING)]),
+    ("message anchor / read until (buckets)", "message_buckets", {"chat_id": "x", "message_ids": "x"}, None),
+]
+
+
+async def ensure_indexes(db):
+    """Create every registered index. Existing indexes with the same spec are left untouched."""
+    for collection, models in INDEXES.items():
+        names = await db[collection].create_indexes(models)
+        logging.info(f"Indexes ensured on {collection}: {', '.join(names)}")
+
+
+async def backfill_chat_activity(db):
+    """
+    Set last_activity on chats created before it existed, so they sort correctly in the
+    chat list, once: completion is recorded in the migrations collection.
+    """
+    if await db.migrations.find_one({"_id": "chat_activity"}):
+        return
+    result = await db.chats.update_many(
+        {"last_activity": {"$exists": False}},
+        [{"$set": {"last_activity": {"$ifNull": ["$last_message_time", "$created_at"]}}}],
+    )
+    await db.migrations.update_one(
+        {"_id": "chat_activity"}, {"$setOnInsert": {"completed_at": datetime.now()}}, upsert=True
+    )
+    if result.modified_count:
+        logging.info(f"Backfilled last_activity on {result.modified_count} chats")
+
+
+async def backfill_search_keys(db, batch_size: int = 1000):
+    """
+    Compute search_keys for users registered before user search used them, once:
+    completion is recorded in the migrations collection.
+    """
+    if await db.migrations.find_one({"_id": "search_keys"}):
+        return
+    updates, total = [], 0
+    projection = {"_id": 0, "user_id": 1, "username": 1, "first_name": 1, "last_name": 1}
+    async for user in db.users.find({"search_keys": {"$exists": False}}, projection):
+        keys = search_keys(user.get("username", ""), user.get("first_name", ""), user.get("last_name", ""))
+        updates.append(UpdateOne({"user_id": user["user_id"]}, {"$set": {"search_keys": keys}}))
+        if len(updates) == batch_size:
+            await db.users.bulk_write(updates, ordered=False)
+            total, updates = total + len(updates), []
+    if updates:
+        await db.users.bulk_write(updates, ordered=False)
+        total += len(updates)
+    await db.migrations.update_one(
+        {"_id": "search_keys"}, {"$setOnInsert": {"completed_at": datetime.now()}}, upsert=True
+    )
+    if total:
+        logging.info(f"Backfilled search_keys on {total} users")
+
+
+async def backfill_chat_summaries(db, batch_size: int = 1000):
+    """
+    Create the chat_summaries of chats created before the chat list read from them,
+    once: completion is recorded in the migrations collection. Upserts with
+    $setOnInsert, so an interrupted run can simply be repeated.
+    """
+    if await db.migrations.find_one({"_id": "chat_summaries"}):
+        return
+    updates, total = [], 0
+    async for chat in db.chats.find({}, {"_id": 0}):
+        for summary in new_summaries(chat):
+            key = {"chat_id": summary["chat_id"], "user_id": summary["user_id"]}
+            updates.append(UpdateOne(key, {"$setOnInsert": summary}, upsert=True))
+        if len(updates) >= batch_size:
+            await db.chat_summaries.bulk_write(updates, ordered=False)
+            total, updates = total + len(updates), []
+    if updates:
+        await db.chat_summaries.bulk_write(updates, ordered=False)
+        total += len(updates)
+    await db.migrations.update_one(
+        {"_id": "chat_summaries"}, {"$setOnInsert": {"completed_at": datetime.now()}}, upsert=True
+    )
+    if total:
+        logging.info(f"Backfilled {total} chat summaries")
+
+
+async def backfill_bucket_message_ids(db):
+    """
+    List the message_ids of buckets written before BucketStore.find used them, once:
+    completion is recorded in the migrations collection. Open parts are rewritten in one
+    update; compressed blocks are decoded one at a time.
+    """
+    if await db.migrations.find_one({"_id": "bucket_message_ids"}):
+        return
+    result = await db.message_buckets.update_many(
+        {"block": {"$exists": False}}, [{"$set": {"message_ids": "$messages.message_id"}}]
+    )
+    total = result.modified_count
+    async for bucket in db.message_buckets.find({"block": {"$exists": True}, "message_ids": {"$exists": False}}):
+        message_ids = [m["message_id"] for m in BucketStore._unpack(bucket)]
+        await db.message_buckets.update_one({"_id": bucket["_id"]}, {"$set": {"message_ids": message_ids}})
+        total += 1
+    await db.migrations.update_one(
+        {"_id": "bucket_message_ids"}, {"$setOnInsert": {"completed_at": datetime.now()}}, upsert=True
+    )
+    if total:
+        logging.info(f"Backfilled message_ids on {total} message buckets")
+
+
+def _plan_stages(plan) -> List[str]:
+    """Collect every stage name in an explain() plan tree."""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(_plan_stages(item))
+    return stages
+
+
+async def check_query_plans(db) -> List[str]:
+    """Explain each hot query and return the descriptions of those that fall back to COLLSCAN."""
+    failures = []
+    for description, collection, query, sort in HOT_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        stages = _plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        if "COLLSCAN" in stages:
+            failures.append(f"{description}: {collection}.find({query}) uses COLLSCAN")
+        else:
+            logging.info(f"{description}: {' <- '.join(stages)}")
+    return failures
+
+
+async def _main(check: bool) -> int:
+    from database import get_db, close_db
+
+    db = await get_db()
+    try:
+        if not check:
+            await ensure_indexes(db)
+            await backfill_chat_activity(db)
+            await backfill_search_keys(db)
+            await backfill_chat_summaries(db)
+            await backfill_bucket_message_ids(db)
+            return 0
+        failures = await check_query_plans(db)
+        for failure in failures:
+            logging.error(failure)
+        return 1 if failures else 0
+    finally:
+        close_db()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    sys.exit(asyncio.run(_main("--check" in sys.argv[1:])))
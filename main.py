@@ -1,14 +1,59 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Depends, WebSocket
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
 import logging
+from database import connect_db, close_db, get_db, get_pool_stats
+from indexes import (
+    ensure_indexes, backfill_chat_activity, backfill_search_keys, backfill_chat_summaries, backfill_bucket_message_ids,
+)
+from config import MONGO_ENSURE_INDEXES
+from auth.cache import principal_cache
+from chat.cache import membership_cache, sender_cache
+from chat.writer import message_writer
+from chat.store import message_compactor
+from auth.utils import password_hasher
 from auth.routes import router as auth_router
-from chat.websocket import sse_endpoint, send_message_endpoint  # Import SSE functions
+from chat.websocket import sse_endpoint, send_message_endpoint, websocket_endpoint, manager, SendMessageRequest
 from chat.routes import router as chat_router
 from users.routes import router as user_router
-from erroremail import send_error_email
+from erroremail import error_notifier
+from metrics import registry, loop_lag_monitor, MetricsMiddleware
+from compression import CompressionMiddleware
+from admission import admission, AdmissionMiddleware
 import traceback
 
-app = FastAPI(title="ZeroHour Chat API", version="1.0.0", debug=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the shared MongoDB client on startup and close it on shutdown."""
+    connect_db()
+    loop_lag_monitor.start()
+    error_notifier.start()
+    await manager.start()
+    message_writer.start()
+    message_compactor.start()
+    if MONGO_ENSURE_INDEXES:
+        try:
+            db = await get_db()
+            await ensure_indexes(db)
+            await backfill_chat_activity(db)
+            await backfill_search_keys(db)
+            await backfill_chat_summaries(db)
+            await backfill_bucket_message_ids(db)
+        except Exception as e:
+            logging.error(f"Failed to ensure MongoDB indexes: {e}")
+    yield
+    await manager.stop()
+    await message_writer.stop()
+    await message_compactor.stop()
+    await error_notifier.stop()
+    password_hasher.shutdown()
+    await loop_lag_monitor.stop()
+    close_db()
+
+
+app = FastAPI(title="ZeroHour Chat API", version="1.0.0", debug=True, lifespan=lifespan)
 
 app.include_router(auth_router)
 app.include_router(user_router)
@@ -19,51 +64,162 @@ async def root():
     return {"message": "ZeroHour Chat API is running!"}
 
 
+@app.get("/health/db")
+async def db_pool_stats():
+    """Connection pool counters for sizing MONGO_MAX_POOL_SIZE"""
+    return get_pool_stats()
+
+
+@app.get("/health/auth-cache")
+async def auth_cache_stats():
+    """Hit/miss counters of the authenticated-principal cache"""
+    return principal_cache.stats()
+
+
+@app.get("/health/chat-cache")
+async def chat_cache_stats():
+    """Hit/miss counters of the chat membership and sender-summary caches"""
+    return {"membership": membership_cache.stats(), "sender": sender_cache.stats()}
+
+
+@app.get("/health/broker")
+async def broker_stats():
+    """Fan-out backend and publish-to-delivery latency"""
+    return manager.broker.stats()
+
+
+@app.get("/health/fanout")
+async def fanout_stats():
+    """Fan-out scheduler queue depth, batches and submit-to-delivery latency"""
+    return manager.fanout.stats()
+
+
+@app.get("/health/admission")
+async def admission_stats():
+    """Token-bucket rules, requests in flight per class and 429s so far"""
+    return admission.stats()
+
+
+@app.get("/health/presence")
+async def presence_stats():
+    """Users online on this process and presence writes/events so far"""
+    return manager.presence.stats()
+
+
+@app.get("/health/writer")
+async def writer_stats():
+    """Message write mode, batch sizes and coalesced chat updates"""
+    return message_writer.stats()
+
+
+@app.get("/health/connections")
+async def connection_stats():
+    """Active SSE connections, queue depths and per-connection lag"""
+    return manager.stats()
+
+
+sse_connections = registry.gauge("sse_connections", "Open SSE and WebSocket streams on this process")
+sse_users = registry.gauge("sse_connected_users", "Users with at least one open stream on this process")
+sse_queued = registry.gauge("sse_queued_frames", "Frames waiting in all per-connection delivery queues")
+sse_queue_max = registry.gauge("sse_queue_depth_max", "Deepest per-connection delivery queue")
+sse_dropped = registry.gauge("sse_dropped_frames", "Frames dropped by the overflow policy on open connections")
+hash_pending = registry.gauge("password_hash_pending", "Password hashes queued or running on the hashing pool")
+hash_rejected = registry.gauge("password_hash_rejected", "Hash requests rejected with 503 since start")
+error_queue = registry.gauge("error_notifier_queued", "Error reports waiting for the next digest")
+writer_pending = registry.gauge("message_writer_pending", "Messages queued for the next batched write")
+fanout_pending = registry.gauge("fanout_pending_events", "Events queued on the fan-out scheduler")
+
+
+@registry.on_collect
+def collect_app_state():
+    connections = [c for user_connections in manager.connections.values() for c in user_connections.values()]
+    sse_connections.set(len(connections))
+    sse_users.set(len(manager.connections))
+    sse_queued.set(sum(c.queue.qsize() for c in connections))
+    sse_queue_max.set(max((c.queue.qsize() for c in connections), default=0))
+    sse_dropped.set(sum(c.dropped for c in connections))
+    hash_pending.set(password_hasher.pending)
+    hash_rejected.set(password_hasher.rejected)
+    error_queue.set(error_notifier.queue.qsize())
+    writer_pending.set(message_writer.stats()["pending"])
+    fanout_pending.set(manager.fanout.pending)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus text exposition of request, MongoDB, event-loop and connection metrics"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
 # Allow origins (frontend URLs)
 origins = [
     "https://zerohour-react.vercel.app",  # deployed React app
     "http://localhost:3000"  # React local
 ]
 
+# Innermost, so 429s still get CORS headers and are seen by the metrics middleware
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=origins,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Before-Cursor", "X-After-Cursor", "ETag", "Retry-After"],
 )
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 # Register SSE endpoint
 @app.get("/sse/{user_id}")
-async def sse(request: Request, user_id: str):
+async def sse(request: Request, user_id: str, db=Depends(get_db)):
     """Server-Sent Events endpoint for real-time messages"""
-    return await sse_endpoint(request, user_id)
+    return await sse_endpoint(request, user_id, db)
 
 # Register send message endpoint
 @app.post("/api/send/{user_id}")
-async def send_message(user_id: str, message_request: dict):
+async def send_message(user_id: str, message_request: SendMessageRequest, db=Depends(get_db)):
     """Send a message to a chat"""
-    from chat.websocket import SendMessageRequest
-    return await send_message_endpoint(user_id, SendMessageRequest(**message_request))
+    return await send_message_endpoint(user_id, message_request, db)
+
+
+def _route_path(request: Request) -> str:
+    """Route template (e.g. /api/chats/{chat_id}/messages) so errors group per endpoint."""
+    route = request.scope.get("route")
+    return getattr(route, "path", request.url.path)
+
+
+# Register WebSocket endpoint
+@app.websocket("/ws")
+async def websocket(websocket: WebSocket, db=Depends(get_db)):
+    """WebSocket transport: authenticate once with ?token=, then send and receive on one socket"""
+    await websocket_endpoint(websocket, db)
 
 
 @app.middleware("http")
 async def error_email_middleware(request: Request, call_next):
-    """Catch all responses and send email on 3xx/4xx/5xx with full traceback."""
+    """
+    Report 3xx/4xx/5xx responses and unhandled exceptions with full traceback.
+    Reports are queued to the background error notifier, which dedups and batches them.
+    """
     try:
         response = await call_next(request)
 
         # For HTTP errors (e.g., raised via HTTPException)
-        if 300 <= response.status_code < 600 and response.status_code != 307 and request.method != 'OPTIONS':
+        if 300 <= response.status_code < 600 and response.status_code not in (304, 307, 429) and request.method != 'OPTIONS':
+            tb = traceback.format_exc()
             body = (
                 f"URL: {request.url}\n"
                 f"Method: {request.method}\n"
                 f"Status Code: {response.status_code}\n"
-                f"Full Traceback:\n{traceback.format_exc()}"
+                f"Full Traceback:\n{tb}"
+            )
+            error_notifier.notify(
+                f"🚨 FastAPI Error {response.status_code}",
+                body,
+                error_notifier.fingerprint(request.method, _route_path(request), str(response.status_code), tb),
             )
-            send_error_email(f"🚨 FastAPI Error {response.status_code}", body)
 
         return response
 
@@ -76,7 +232,15 @@ async def error_email_middleware(request: Request, call_next):
             f"Error: {str(e)}\n\n"
             f"Full Traceback:\n{tb}"
         )
-        send_error_email("🚨 FastAPI Unhandled Exception", body)
+        error_notifier.notify(
+            "🚨 FastAPI Unhandled Exception",
+            body,
+            error_notifier.fingerprint(request.method, _route_path(request), "exception", tb),
+        )
         raise
 
 
+
+
+# Added last so it is the outermost layer and times the whole stack
+app.add_middleware(MetricsMiddleware)
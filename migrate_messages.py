@@ -0,0 +1,74 @@
+"""
+Copy messages from the `messages` collection into bucketed storage (MESSAGE_STORAGE=buckets,
+see chat/store.py), then compact windows older than MESSAGE_COMPACT_AFTER_SECONDS.
+
+The copy walks messages in (chat_id, timestamp, message_id) order and records its
+position in the migrations collection after every batch, so it can be interrupted and
+run again. To switch without losing messages: run it, set MESSAGE_STORAGE=buckets and
+restart, then run it once more to copy what was sent in between. The `messages`
+collection is left untouched; drop it once the bucketed history has been checked.
+
+Usage:
+    python migrate_messages.py              # copy (resumes where it stopped) and compact
+    python migrate_messages.py --compact    # only compact old windows
+"""
+import sys
+import asyncio
+import logging
+from datetime import datetime
+from chat.store import BucketStore
+
+BATCH_SIZE = 5000
+MIGRATION_ID = "message_buckets"
+
+
+def _after(position: dict) -> dict:
+    """Messages after a (chat_id, timestamp, message_id) position, in index order."""
+    return {"$or": [
+        {"chat_id": {"$gt": position["chat_id"]}},
+        {"chat_id": position["chat_id"], "timestamp": {"$gt": position["timestamp"]}},
+        {"chat_id": position["chat_id"], "timestamp": position["timestamp"],
+         "message_id": {"$gt": position["message_id"]}},
+    ]}
+
+
+async def copy_messages(db, store: BucketStore, batch_size: int = BATCH_SIZE) -> int:
+    state = await db.migrations.find_one({"_id": MIGRATION_ID}) or {}
+    position = state.get("position")
+    copied = 0
+    while True:
+        batch = await db.messages.find(_after(position) if position else {}, {"_id": 0}).sort(
+            [("chat_id", 1), ("timestamp", 1), ("message_id", 1)]
+        ).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        await store.insert(db, batch)
+        last = batch[-1]
+        position = {"chat_id": last["chat_id"], "timestamp": last["timestamp"], "message_id": last["message_id"]}
+        await db.migrations.update_one(
+            {"_id": MIGRATION_ID}, {"$set": {"position": position, "updated_at": datetime.now()}}, upsert=True
+        )
+        copied += len(batch)
+        logging.info(f"Copied {copied} messages (at chat {last['chat_id']})")
+    return copied
+
+
+async def _main(compact_only: bool) -> int:
+    from database import get_db, close_db
+
+    db = await get_db()
+    store = BucketStore()
+    try:
+        if not compact_only:
+            copied = await copy_messages(db, store)
+            logging.info(f"Copied {copied} messages into message_buckets")
+        compacted = await store.compact(db)
+        logging.info(f"Compacted {compacted} bucket windows")
+        return 0
+    finally:
+        close_db()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    sys.exit(asyncio.run(_main("--compact" in sys.argv[1:])))
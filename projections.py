@@ -0,0 +1,41 @@
+"""
+Field projections, one per query shape. Reads ask MongoDB for exactly the fields
+the caller uses, so password_hash, security_phrase and search_keys only leave
+the database for the login check that needs the hash.
+"""
+
+# auth.get_current_user: the fields of UserOut
+PRINCIPAL_PROJECTION = {
+    "_id": 1, "user_id": 1, "first_name": 1, "last_name": 1, "mobile_no": 1, "email": 1,
+    "username": 1, "created_at": 1, "is_online": 1,
+}
+
+# auth.login: UserOut plus the hash to verify
+LOGIN_PROJECTION = {**PRINCIPAL_PROJECTION, "password_hash": 1}
+
+# Existence checks
+EXISTS_PROJECTION = {"_id": 1}
+
+# Public summary shown next to messages (sender) and in the chat list (other_user)
+USER_SUMMARY_PROJECTION = {"_id": 0, "user_id": 1, "username": 1, "first_name": 1, "last_name": 1}
+
+# Summary plus what presence.is_online needs
+USER_PRESENCE_PROJECTION = {**USER_SUMMARY_PROJECTION, "is_online": 1, "last_seen": 1}
+
+# users.search_users; never password_hash or security_phrase
+SEARCH_PROJECTION = USER_PRESENCE_PROJECTION
+
+# Chat model fields
+CHAT_PROJECTION = {"_id": 0}
+
+# chat.get_user_chats page, from chat_summaries
+CHAT_SUMMARY_PROJECTION = {
+    "_id": 0, "chat_id": 1, "other_user_id": 1, "is_group": 1, "name": 1, "unread_count": 1, "last_read_at": 1,
+    "last_message": 1, "last_message_time": 1, "last_sender_id": 1, "created_at": 1, "last_activity": 1,
+}
+
+# Member lists from chat_summaries (chat_id_user_id_unique index) and user existence checks
+MEMBER_PROJECTION = {"_id": 0, "user_id": 1}
+
+# chat.get_chat_messages; chat_id and message_type are implied by the request
+MESSAGE_PROJECTION = {"_id": 0, "message_id": 1, "sender_id": 1, "content": 1, "timestamp": 1}
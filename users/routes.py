@@ -1,33 +1,28 @@
+from typing import List
 from fastapi import APIRouter, Depends
+from fastapi.responses import ORJSONResponse
 from database import get_db
 from auth.models import User
+from auth.customPydantic import UserSearchResult
 from auth.utils import get_current_user
+from chat.websocket import presence
+from users.search import find_users
 
 
 router = APIRouter(prefix="/api/users", tags=["Users"])
 
 # User endpoints
-@router.get("/search")
-async def search_users(query: str, current_user: User = Depends(get_current_user)):
-    db = await get_db()
-    users = await db.users.find({
-        "$and": [
-            {"user_id": {"$ne": current_user.user_id}},
-            {"$or": [
-                {"username": {"$regex": query, "$options": "i"}},
-                {"first_name": {"$regex": query, "$options": "i"}},
-                {"last_name": {"$regex": query, "$options": "i"}}
-            ]}
-        ]
-    }).to_list(20)
+@router.get("/search", response_model=List[UserSearchResult])
+async def search_users(query: str, current_user: User = Depends(get_current_user), db=Depends(get_db)):
+    users = await find_users(db, query, exclude_user_id=current_user.user_id)
 
-    return [
+    return ORJSONResponse([
         {
             "user_id": user["user_id"],
             "username": user["username"],
             "first_name": user["first_name"],
             "last_name": user["last_name"],
-            "is_online": user.get("is_online", False)
+            "is_online": presence.is_online(user)
         } for user in users
-    ]
+    ])
 
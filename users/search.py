@@ -0,0 +1,133 @@
+import re
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from config import USER_SEARCH_BACKEND, USER_SEARCH_REFRESH_SECONDS
+from projections import SEARCH_PROJECTION
+
+SEARCH_LIMIT = 20
+MAX_QUERY_LENGTH = 64
+
+
+def normalize(text: str) -> str:
+    """Case- and accent-insensitive form of a name: "  José  Díaz" -> "jose diaz"."""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.casefold().split())
+
+
+def search_keys(username: str, first_name: str, last_name: str) -> List[str]:
+    """
+    Normalized keys stored on the user document (`search_keys`, multikey indexed);
+    a search matches users with a key starting with the normalized query.
+    """
+    keys = [normalize(username), normalize(first_name), normalize(last_name), normalize(f"{first_name} {last_name}")]
+    return sorted({key for key in keys if key})
+
+
+class PrefixIndex:
+    """
+    In-process alternative to the MongoDB prefix query (USER_SEARCH_BACKEND=memory).
+    Keys are kept as one sorted list of (key, user_id), so a prefix lookup is a binary
+    search plus a short scan, the same walk a trie would do with far less memory per key.
+    New registrations are added directly; users created on other processes are picked
+    up every USER_SEARCH_REFRESH_SECONDS by created_at.
+    """
+
+    def __init__(self, refresh_seconds: float = USER_SEARCH_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._entries: List[Tuple[str, str]] = []
+        self._users: Dict[str, List[str]] = {}  # user_id -> its keys, for updates and removal
+        self._watermark: Optional[datetime] = None
+        self._refreshed_at = 0.0
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def add(self, user_id: str, keys: List[str]):
+        if user_id in self._users:
+            self.remove(user_id)
+        self._users[user_id] = keys
+        for key in keys:
+            insort(self._entries, (key, user_id))
+
+    def remove(self, user_id: str):
+        for key in self._users.pop(user_id, []):
+            i = bisect_left(self._entries, (key, user_id))
+            if i < len(self._entries) and self._entries[i] == (key, user_id):
+                del self._entries[i]
+
+    def load(self, users: List[Tuple[str, List[str]]]):
+        """Bulk-add (user_id, keys) pairs with a single sort."""
+        for user_id, _ in users:
+            self.remove(user_id)  # while the list is still sorted
+        for user_id, keys in users:
+            self._users[user_id] = keys
+            self._entries.extend((key, user_id) for key in keys)
+        self._entries.sort()
+
+    def search(self, prefix: str, limit: int = SEARCH_LIMIT, exclude_user_id: Optional[str] = None) -> List[str]:
+        user_ids: List[str] = []
+        seen = set()
+        i = bisect_left(self._entries, (prefix,))
+        while i < len(self._entries) and len(user_ids) < limit:
+            key, user_id = self._entries[i]
+            if not key.startswith(prefix):
+                break
+            if user_id != exclude_user_id and user_id not in seen:
+                seen.add(user_id)
+                user_ids.append(user_id)
+            i += 1
+        return user_ids
+
+    async def refresh(self, db, force: bool = False):
+        """Load users created since the last refresh (everyone on the first call)."""
+        if not force and time.monotonic() - self._refreshed_at < self.refresh_seconds:
+            return
+        self._refreshed_at = time.monotonic()
+        query = {"created_at": {"$gte": self._watermark}} if self._watermark else {}
+        users = []
+        projection = {"_id": 0, "user_id": 1, "username": 1, "first_name": 1, "last_name": 1,
+                      "search_keys": 1, "created_at": 1}
+        async for user in db.users.find(query, projection):
+            keys = user.get("search_keys") or search_keys(
+                user.get("username", ""), user.get("first_name", ""), user.get("last_name", "")
+            )
+            users.append((user["user_id"], keys))
+            created_at = user.get("created_at")
+            if created_at and (self._watermark is None or created_at > self._watermark):
+                self._watermark = created_at
+        self.load(users)
+
+
+user_index = PrefixIndex()
+
+
+def remember_user(user: dict):
+    """Make a newly registered user searchable on this process right away."""
+    if USER_SEARCH_BACKEND == "memory":
+        user_index.add(user["user_id"], user["search_keys"])
+
+
+async def find_users(db, query: str, exclude_user_id: Optional[str] = None, limit: int = SEARCH_LIMIT) -> List[dict]:
+    """Users whose username, first name, last name or full name starts with `query`."""
+    prefix = normalize(query[:MAX_QUERY_LENGTH])
+    if not prefix:
+        return []
+
+    if USER_SEARCH_BACKEND == "memory":
+        await user_index.refresh(db)
+        user_ids = user_index.search(prefix, limit, exclude_user_id)
+        users = {
+            user["user_id"]: user
+            async for user in db.users.find({"user_id": {"$in": user_ids}}, SEARCH_PROJECTION)
+        }
+        return [users[user_id] for user_id in user_ids if user_id in users]
+
+    # Escaped and anchored, so MongoDB turns it into a bounded scan of the search_keys index
+    query_filter = {"search_keys": {"$regex": f"^{re.escape(prefix)}"}}
+    if exclude_user_id:
+        query_filter["user_id"] = {"$ne": exclude_user_id}
+    return await db.users.find(query_filter, SEARCH_PROJECTION).limit(limit).to_list(limit)